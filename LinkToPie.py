@@ -1,25 +1,42 @@
 from __future__ import print_function
 import socket
-import edn_format
+import carabiner_edn
 import os
 import numpy as np
 import time
 import threading
 import errno
+import select
 from socket import error as socket_error
 import warnings
+import traceback
+import asyncio
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import Future, InvalidStateError, TimeoutError as FutureTimeoutError
+
+# commands that Carabiner answers with a message of another type
+REPLY_TYPES = {'bpm': 'status', 'force-beat-at-time': 'status', 'request-beat-at-time': 'status'}
+KNOWN_COMMANDS = {'status', 'beat-at-time', 'phase-at-time', 'time-at-beat'}  # answered with their own type
 
 class LinkInterface():
     """A simple python client to communicate with carabiner (a Abelton Link connector)
-        Carabiner server must be running to use. Requires edn_format [$pip install edn_format]"""
+        Carabiner server must be running to use. Unusual messages need edn_format [$pip install edn_format]"""
 
     def __init__(self, path_to_carabiner=None, tcp_ip='127.0.0.1', tcp_port=17000, buffer_size=1024, callbacks=None):
         self._tcp_ip = tcp_ip
         self._tcp_port = tcp_port
         self._buffer_size = buffer_size
+        self._running = True
+        self.parse_errors = 0  # messages from Carabiner that could not be decoded
+        self.last_parse_error = None  # (message, exception) of the most recent one
         self.start_ = -1
         self.bpm_ = 120
         self.beat_ = -1
+        self._pending = {}  # reply type -> deque of futures, oldest first
+        self._send_lock = threading.Lock()
+        self._local = threading.local()  # per thread pipeline
+        self.timeline = LinkTimeline()  # answers beat and phase queries locally
 
         if callbacks is None:
             self.callbacks = {}
@@ -28,100 +45,174 @@ class LinkInterface():
 
         self.start_carabiner_and_open_socket(path_to_carabiner)
 
-        thread = threading.Thread(target=self._listener)
-        thread.daemon = True
-        thread.start()
+        self._listener_thread = threading.Thread(target=self._listener)
+        self._listener_thread.daemon = True
+        self._listener_thread.start()
         print('LinkInterface Started')
 
     def decode_edn_msg(self, msg):
         """Decodes a TCP message from Carabiner to python dictionary"""
-        msg = msg.decode()
-        msg_type = msg[:msg.index(' {')]
-        striped_msg = msg[msg.index('{'):]
-        decoded_msg = edn_format.loads(striped_msg)
-
-        # Because the edn_format package does not return normal dam dicts (or string keywords). What dicts.
-        if type(decoded_msg) is edn_format.immutable_dict.ImmutableDict:
-            decoded_msg = {str(key).strip(':'): value for key, value in decoded_msg.dict.items()}
-
-        return msg_type, decoded_msg
+        return carabiner_edn.decode_message(msg)
 
     def status(self, callback=None):
         """Wrapper for Status"""
-        self.s.send(b' status')
-        if callback is not None:
-            self.callbacks['status'] = callback
+        return self._command('status', callback)
 
     def set_bpm(self, bpm, callback=None):
         """Wrapper for bpm"""
-        msg = 'bpm ' + str(bpm)
-        self.s.send(msg.encode())
-        if callback is not None:
-            self.callbacks['bpm'] = callback
+        return self._command('bpm', callback, bpm)
 
     def beat_at_time(self, time_in_ms, quantum=8, callback=None):
         """Wrapper for Beat At Time"""
-        msg = 'beat-at-time ' + str(time_in_ms) + ' ' + str(quantum)
-        self.s.send(msg.encode())
-        if callback is not None:
-            self.callbacks['beat-at-time'] = callback
+        return self._command('beat-at-time', callback, time_in_ms, quantum)
 
     def time_at_beat(self, beat, quantum=8, callback=None):
         """Wrapper for Time At Beat"""
-        msg = 'time-at-beat ' + str(beat) + ' ' + str(quantum)
-        self.s.send(msg.encode())
-        if callback is not None:
-            self.callbacks['time-at-beat'] = callback
+        return self._command('time-at-beat', callback, beat, quantum)
 
     def phase_at_time(self, time_in_ms, quantum=8, callback=None):
         """Wrapper for Phase At Time"""
-        msg = ' phase-at-time ' + str(time_in_ms) + ' ' + str(quantum)
-        self.s.send(msg.encode())
-        if callback is not None:
-            self.callbacks['phase-at-time'] = callback
+        return self._command('phase-at-time', callback, time_in_ms, quantum)
 
     def force_beat_at_time(self, beat, time_in_ms, quantum=8, callback=None):
         """Wrapper for Beat At Time"""
-        msg = 'force-beat-at-time ' + str(beat) + ' ' + str(time_in_ms) + ' ' + str(quantum)
-        self.s.send(msg.encode())
-        if callback is not None:
-            self.callbacks['force-beat-at-time'] = callback
+        return self._command('force-beat-at-time', callback, beat, time_in_ms, quantum)
 
     def request_beat_at_time(self, beat, time_in_ms, quantum=8, callback=None):
-        msg = 'request-beat-at-time ' + str(beat) + ' ' + str(time_in_ms) + ' ' + str(quantum)
-        self.s.send(msg.encode())
+        return self._command('request-beat-at-time', callback, beat, time_in_ms, quantum)
+
+    def _command(self, name, callback, *args):
+        """ Legacy wrappers: the callback slot for the message type is still set, the future is returned as well """
         if callback is not None:
-            self.callbacks['request-beat-at-time'] = callback
-
-    # def time_of_next_beat(self, quantum=8):
-    #     """Returns a tuple (beat, time) that specifies the next whole beat number at its time,
-    #     in ms (for the given quantum) - this needs work..."""
-    #     ret = self.beat_at_time(self.now(), quantum)
-    #     next_beat = np.ceil(ret['beat'])
-    #     ret = self.time_at_beat(next_beat, quantum)
-    #     return (ret['beat'], ret['when'])
-    #
-    # def test_timer(self):
-    #     """A function to test the error in clock times as provided by link vs system time
-    #     This should be run without anny peers connected - broken"""
-    #     status = self.status()
-    #     bpm = int(status['bpm'])
-    #     beats_per_ms = bpm / 60.0 / 1000.0 / 1000.0
-    #     ms_per_beat = 1.0 / beats_per_ms
-    #     beat, time_of_beat = self.time_of_next_beat()
-    #     # Next 100 beats:
-    #     beat_times = np.array([time_of_beat + beat_inc * ms_per_beat for beat_inc in range(0, bpm)])
-    #     beats = np.array([beat + beat_inc for beat_inc in range(0, bpm)])
-    #     beat_diff = []
-    #     print('Beginning bpm beat test, this will take 1 minute')
-    #     for beat_idx, beat_time in enumerate(beat_times):
-    #         while self.now() < beat_time:
-    #             pass
-    #         ret = self.beat_at_time(self.now())
-    #         beat_diff.append(ret['beat'] - beats[beat_idx])
-    #     print('Mean (std) of difference between system time and link time @ bpm =', bpm, 'is', np.mean(beat_diff),
-    #           ' (' + str(np.std(beat_diff)) + ') beats')
-    #     print('Note that is includes TCP and carabiner processing times, so a small positive number is ok :)')
+            self.callbacks[name] = callback
+        return self.request(name, *args)
+
+    def request(self, name, *args):
+        """
+        Send a command to Carabiner, return a concurrent.futures.Future for the decoded reply.
+        Carabiner answers the commands of one type in order, so replies are matched to the oldest
+        pending future of their type. Inside `with link.pipeline():` the command is only queued and
+        goes out in a single socket write with all the others when the block ends.
+        """
+        future = Future()
+        command = ' '.join([name] + [str(arg) for arg in args]) + '\n'
+        request = (REPLY_TYPES.get(name, name), future, command.encode())
+
+        pipeline = getattr(self._local, 'pipeline', None)
+        if pipeline is not None:
+            pipeline.append(request)
+        else:
+            self._send_requests([request])
+        return future
+
+    def query(self, name, *args, timeout=1.):
+        """ Send a command and wait for its reply, raises concurrent.futures.TimeoutError """
+        future = self.request(name, *args)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()  # its reply, should it still come, is dropped
+            raise
+
+    async def query_async(self, name, *args, timeout=1.):
+        """ asyncio variant of query, raises asyncio.TimeoutError """
+        return await asyncio.wait_for(asyncio.wrap_future(self.request(name, *args)), timeout)
+
+    @contextmanager
+    def pipeline(self):
+        """ Collect all requests made by this thread in the block and send them in one write """
+        if getattr(self._local, 'pipeline', None) is not None:  # nested, the outer block sends
+            yield
+            return
+        self._local.pipeline = []
+        try:
+            yield
+        finally:
+            requests, self._local.pipeline = self._local.pipeline, None
+            if requests:
+                self._send_requests(requests)
+
+    def _send_requests(self, requests):
+        # futures are queued under the same lock as the write, so the queue order is the wire order
+        with self._send_lock:
+            sent = self.now()
+            queued = []
+            for reply_type, future, _ in requests:
+                entry = (future, sent)
+                self._pending.setdefault(reply_type, deque()).append(entry)
+                queued.append((reply_type, entry))
+            try:
+                self.s.sendall(b''.join(command for _, _, command in requests))
+            except OSError as e:
+                # no reply will come for these, left queued they would take the replies of later requests
+                for reply_type, entry in queued:
+                    try:
+                        self._pending[reply_type].remove(entry)
+                    except ValueError:
+                        pass
+                    self._fail(entry[0], e)
+
+    def _pop_pending(self, reply_type):
+        """
+        The oldest pending request (future, time sent) of a reply type, None for unsolicited replies
+        (e.g. a status push after a tempo change). Cancelled requests still use up their reply.
+        """
+        queue = self._pending.get(reply_type)
+        try:
+            return queue.popleft()
+        except (AttributeError, IndexError):
+            return None
+
+    def _resolve(self, pending, result=None, exception=None):
+        """ Complete the future of a request from _pop_pending """
+        if pending is None:
+            return
+        future = pending[0]
+        if exception is not None:
+            self._fail(future, exception)
+        elif not future.cancelled():
+            try:
+                future.set_result(result)
+            except InvalidStateError:
+                pass  # cancelled in the meantime
+
+    @staticmethod
+    def _fail(future, exception):
+        if not future.cancelled():
+            try:
+                future.set_exception(exception)
+            except InvalidStateError:
+                pass
+
+    def time_of_next_beat(self, quantum=8, timeout=1.):
+        """Returns a tuple (beat, time) that specifies the next whole beat number at its time,
+        in µs (for the given quantum)"""
+        ret = self.query('beat-at-time', self.now(), quantum, timeout=timeout)
+        next_beat = np.ceil(ret['beat'])
+        ret = self.query('time-at-beat', next_beat, quantum, timeout=timeout)
+        return (ret['beat'], ret['when'])
+
+    def test_timer(self, duration=60., quantum=8, timeout=1.):
+        """A function to test the error in clock times as provided by link vs system time
+        This should be run without any peers connected"""
+        status = self.query('status', timeout=timeout)
+        bpm = status['bpm']
+        us_per_beat = 60.0 * 1000.0 * 1000.0 / bpm
+        beat, time_of_beat = self.time_of_next_beat(quantum, timeout=timeout)
+        nbeats = int(duration * bpm / 60)
+        beat_times = time_of_beat + np.arange(nbeats) * us_per_beat
+        beats = beat + np.arange(nbeats)
+        beat_diff = []
+        print('Beginning bpm beat test, this will take', duration, 'seconds')
+        for beat_idx, beat_time in enumerate(beat_times):
+            while self.now() < beat_time:
+                pass
+            ret = self.query('beat-at-time', self.now(), quantum, timeout=timeout)
+            beat_diff.append(ret['beat'] - beats[beat_idx])
+        print('Mean (std) of difference between system time and link time @ bpm =', bpm, 'is', np.mean(beat_diff),
+              ' (' + str(np.std(beat_diff)) + ') beats')
+        print('Note that is includes TCP and carabiner processing times, so a small positive number is ok :)')
+        return beat_diff
 
     def now(self):
         """Returns the monotonic system time as used by Link. This is in ms, and is the same format as 'start'
@@ -155,27 +246,198 @@ class LinkInterface():
                 time.sleep(0.1)
 
     def _listener(self):
-        while True:
-            msg = self.s.recv(self._buffer_size)
+        """ Read from the socket and handle every complete message, however TCP splits or merges them """
+        framer = MessageFramer()
+        # the socket stays blocking, a timeout on it would also cut off writes from other threads
+        while self._running:
             try:
-                msg_type, msg_data = self.decode_edn_msg(msg)
+                readable, _, _ = select.select([self.s], [], [], 0.5)  # wake up regularly to notice close()
+                if not readable:
+                    continue
+                data = self.s.recv(self._buffer_size)
+            except (OSError, ValueError):  # ValueError: closed in the meantime
+                break
+            if not data:
+                warnings.warn('Carabiner closed the connection')
+                break
+            received = self.now()
+            for msg in framer.feed(data):
+                self._handle_message(msg, received)
+        self._fail_pending(ConnectionError('Connection to Carabiner lost'))
 
-                if msg_type == 'status':
-                    self.bpm_ = msg_data['bpm']
-                    self.beat_ = msg_data['beat']
-                    self.start_ = msg_data['start']
+    def _handle_message(self, msg, received=None):
+        try:
+            msg_type, msg_data = self.decode_edn_msg(msg)
+        except Exception as e:
+            self.parse_errors += 1
+            self.last_parse_error = (msg, e)
+            if self.parse_errors == 1 or self.parse_errors % 100 == 0:
+                warnings.warn(f'Could not decode message from Carabiner ({self.parse_errors} so far): {msg!r}')
+            return
 
-                if msg_type == 'time_at_beat':
-                    self.next_beat_ = (msg_data['beat'], msg_data['when'])
+        if msg_type == 'time-at-beat':
+            self.next_beat_ = (msg_data['beat'], msg_data['when'])
 
-                if msg_type in self.callbacks:
-                    self.callbacks[msg_type](msg_data)
-            except:
-                continue
+        if msg_type == 'unsupported' or msg_type.startswith('bad-'):
+            # an error instead of the reply, it still uses up the oldest request of the command's reply type
+            command = self._failed_command(msg_type, msg_data)
+            if command is None:
+                warnings.warn(f'Error from Carabiner for an unknown command: {msg!r}')
+            else:
+                reason = 'does not support' if msg_type == 'unsupported' else f'rejected ({msg_type})'
+                self._resolve(self._pop_pending(REPLY_TYPES.get(command, command)),
+                              exception=RuntimeError(f'Carabiner {reason} {command}: {msg_data}'))
+        else:
+            pending = self._pop_pending(msg_type)
+            if msg_type == 'status':
+                # before completing the request, so that its caller sees the updated timeline
+                self.bpm_ = msg_data['bpm']
+                self.beat_ = msg_data['beat']
+                self.start_ = msg_data['start']
+                sent = pending[1] if pending is not None else None
+                self.timeline.update(msg_data, sent, received if received is not None else self.now())
+            self._resolve(pending, msg_data)
+
+        if msg_type in self.callbacks:
+            try:
+                self.callbacks[msg_type](msg_data)
+            except Exception:
+                traceback.print_exc()  # a broken callback must not stop the listener
+
+    @staticmethod
+    def _failed_command(msg_type, msg_data):
+        """
+        The command an error reply is about: `unsupported <command>`, `bad-args {:command ...}`,
+        or the command in the error's name as in `bad-bpm <bpm>`. None if it does not say.
+        """
+        if isinstance(msg_data, dict) and 'command' in msg_data:
+            return str(msg_data['command']).lstrip(':')
+        if msg_type == 'unsupported':
+            return str(msg_data).split()[0] if msg_data is not None else None
+        command = msg_type[len('bad-'):]
+        return command if command in REPLY_TYPES or command in KNOWN_COMMANDS else None
+
+    def close(self):
+        self._running = False
+        self.s.close()
+        self._fail_pending(ConnectionError('LinkInterface closed'))
+
+    def _fail_pending(self, exception):
+        with self._send_lock:
+            for queue in self._pending.values():
+                while queue:
+                    self._fail(queue.popleft()[0], exception)
 
     def __del__(self):
         self.s.close()
 
+
+class MessageFramer:
+    """
+    Splits the TCP byte stream from Carabiner into messages, which are terminated by a newline.
+    Partial messages are kept until the rest arrives, a single read may also contain many messages.
+    """
+    delimiter = b'\n'
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """ Add received bytes, return the list of messages completed by them """
+        self.buffer += data
+        end = self.buffer.rfind(self.delimiter)
+        if end < 0:
+            return []
+        messages = [bytes(msg) for msg in self.buffer[:end].split(self.delimiter) if msg.strip()]
+        del self.buffer[:end + 1]
+        return messages
+
+
+class LinkTimeline:
+    """
+    Local model of the Link timeline, so beats and phases can be computed without asking Carabiner.
+
+    Every status reply pairs a Link time (start + beat * 60e6 / bpm) with the local now() halfway
+    between sending the request and receiving the reply. A line through the last `window` pairs
+    gives the offset and drift between the two clocks; pairs far off the line (a reply that got
+    delayed on the way) are dropped before fitting again. Until there are `min_fit` pairs spanning
+    at least `min_span` only the offset is estimated, drift over a shorter span is mostly noise. Tempo and start are taken over from every status as soon as it arrives,
+    including the ones Carabiner pushes by itself. All times are in µs.
+    """
+
+    def __init__(self, window=32, min_fit=8, min_span=10e6, max_round_trip=20e3, outlier_floor=50.):
+        self.window = window
+        self.min_fit = min_fit
+        self.min_span = min_span
+        self.max_round_trip = max_round_trip  # slower replies say little about the clock
+        self.outlier_floor = outlier_floor  # residuals below this are never outliers
+        self.samples = deque(maxlen=window)  # (local time, Link time - local time)
+        self.lock = threading.Lock()
+        # (local time, Link time at that local time, drift, start, bpm), swapped as a whole for the readers
+        self._state = (0., 0., 1., None, 120.)
+
+    @property
+    def ready(self):
+        """ True once the first status has been seen """
+        return self._state[3] is not None
+
+    @property
+    def bpm(self):
+        return self._state[4]
+
+    def update(self, status, sent, received):
+        """ Feed a status message, sent is None for status messages that were not requested """
+        start, bpm = status['start'], status['bpm']
+        with self.lock:
+            local0, link0, drift = self._state[:3]
+            if sent is not None and received - sent <= self.max_round_trip:
+                local = (sent + received) / 2
+                self.samples.append((local, start + status['beat'] * 60e6 / bpm - local))
+                local0, link0, drift = self._fit()
+            self._state = (local0, link0, drift, start, bpm)
+
+    def _fit(self):
+        local, offset = np.array(self.samples).T
+        x = local - local[-1]
+        if len(x) < self.min_fit or -x[0] < self.min_span:
+            return local[-1], local[-1] + np.median(offset), 1.
+
+        inliers = np.ones(len(x), dtype=bool)
+        for _ in range(2):
+            slope, intercept = np.polyfit(x[inliers], offset[inliers], 1)
+            residual = np.abs(offset - (intercept + slope * x))
+            inliers = residual <= max(3 * np.median(residual), self.outlier_floor)
+            if inliers.sum() < self.min_fit // 2:
+                break
+        return local[-1], local[-1] + intercept, 1. + slope
+
+    def link_time(self, t):
+        """ Link time at local time t """
+        local0, link0, drift = self._state[:3]
+        return link0 + drift * (t - local0)
+
+    def local_time(self, link_time):
+        """ Local time at Link time link_time """
+        local0, link0, drift = self._state[:3]
+        return local0 + (link_time - link0) / drift
+
+    def beat_at(self, t):
+        local0, link0, drift, start, bpm = self._state
+        if start is None:
+            raise RuntimeError('No status from Carabiner yet')
+        return (link0 + drift * (t - local0) - start) * bpm / 60e6
+
+    def time_at_beat(self, beat):
+        """ Local time of the beat """
+        local0, link0, drift, start, bpm = self._state
+        if start is None:
+            raise RuntimeError('No status from Carabiner yet')
+        return local0 + (start + beat * 60e6 / bpm - link0) / drift
+
+    def phase_at(self, t, quantum=4):
+        return self.beat_at(t) % quantum
+
+
 if __name__ == "__main__":
     link = LinkInterface("/mnt/c/Users/bdyet/GoogleDrive/PersonalProjects/carabiner/build/bin/Carabiner")
 
@@ -183,5 +445,5 @@ if __name__ == "__main__":
         link.status()
         time.sleep(0.1)
         print(link.bpm_)
-    # print(link.status())
+    # print(link.query('status'))
     # link.test_timer()
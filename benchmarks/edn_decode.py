@@ -0,0 +1,33 @@
+"""
+Decoding speed of Carabiner messages: the general edn_format parser against the flat map fast path
+that LinkInterface now uses, for every message shape Carabiner sends.
+
+Run from the repository root:
+    python -m benchmarks.edn_decode [repeats]
+"""
+import sys
+import timeit
+
+import carabiner_edn
+
+MESSAGES = {
+    "status": b"status {:peers 2 :bpm 120.0 :start 73743731220 :beat 597.2209362897765}",
+    "beat-at-time": b"beat-at-time {:when 73743731220 :quantum 4.0 :beat 597.2209362897765}",
+    "phase-at-time": b"phase-at-time {:when 73743731220 :quantum 4.0 :phase 1.2209362897765}",
+    "time-at-beat": b"time-at-beat {:beat 600.0 :quantum 4.0 :when 73745120000}",
+}
+
+
+def main(repeats=20000):
+    print(f"{'message':<16}{'edn_format µs':>15}{'fast µs':>10}{'speedup':>10}")
+    for name, msg in MESSAGES.items():
+        assert carabiner_edn.decode_message(msg) == carabiner_edn.decode_with_edn_format(msg)
+        slow = min(timeit.repeat(lambda: carabiner_edn.decode_with_edn_format(msg), number=repeats // 10, repeat=3))
+        fast = min(timeit.repeat(lambda: carabiner_edn.decode_message(msg), number=repeats, repeat=3))
+        slow_us = slow / (repeats // 10) * 1e6
+        fast_us = fast / repeats * 1e6
+        print(f"{name:<16}{slow_us:>15.2f}{fast_us:>10.2f}{slow_us / fast_us:>9.0f}x")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
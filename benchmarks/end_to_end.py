@@ -0,0 +1,302 @@
+"""
+End-to-end measurements of the whole system on one box, with local stand-ins for everything outside
+of it: a MQTT broker (mosquitto), benchmarks.fake_carabiner for Carabiner/Link and a virtual MIDI
+output that records when the notes the midi_sequencer writes would sound.
+
+Two processes talk through the broker like the two computers do: this one runs the sequencer user
+interface and the Sampler, a child process (the "sampling computer") runs the midi_sequencer and the
+SampleReceiver. time.monotonic is the same clock in all processes of a box, so times can be compared
+directly.
+
+Measured:
+- click to note: a pad a few steps ahead of the playhead is clicked through sequencer.Sequencer.handle_click,
+  how long until the midi_sequencer has applied the edit, until the note sounds and whether it made its step
+- step timing: sounding time of the notes on the virtual MIDI output against the exact step times of the
+  fake Carabiner's timeline, with every step on, at several tempos (PortMidi timestamps are whole ms,
+  so errors within ±0.5 ms are rounding)
+- sample transfer: Sampler.send_sample until the SampleReceiver announces the saved file on "sampling/saved"
+
+The results are printed as JSON (component logging goes to stderr), to compare versions.
+
+Run from the repository root, with mosquitto on the PATH or MQTT_BROKER set to a running MQTT v5 broker:
+    python -m benchmarks.end_to_end [--output results.json] [--seconds 10] [--tempos 90 120 180]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import contextlib
+import multiprocessing
+import numpy as np
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+from benchmarks.fake_carabiner import FakeCarabiner
+from benchmarks.sample_transfer import make_take
+
+STEPS_PER_BEAT = 4  # as in midi_sequencer.Sequencer
+SETTLE_TIME = 3.  # s after a tempo change, the midi_sequencer polls the status once per second
+TIMING_TRACK, CLICK_TRACK = 0, 1
+
+
+def midi_time():
+    """ Clock of the virtual MIDI output in ms, like pygame.midi.time """
+    return int(time.monotonic() * 1e3)
+
+
+class VirtualMidiOutput:
+    """
+    Stand-in for a pygame.midi.Output opened with a latency: instead of playing the notes it reports
+    (note, time it sounds, time it was written) in µs for each of them to the events queue.
+    """
+    def __init__(self, events, latency):
+        self.events = events
+        self.latency = latency
+
+    def write(self, events):
+        written = time.monotonic() * 1e6
+        for (status, note, velocity), timestamp in events:
+            sounds = max(written, (timestamp + self.latency) * 1e3)  # PortMidi cannot play in the past
+            self.events.put(('note', note, sounds, written))
+
+
+def sampling_computer(carabiner_port, sample_folder, events, stop):
+    """ Child process: midi_sequencer and SampleReceiver with the virtual MIDI output and the fake Carabiner """
+    sys.stdout = sys.stderr
+    import midi_sequencer
+    from LinkToPie import LinkInterface
+    from sample_receiver import SampleReceiver
+
+    output = VirtualMidiOutput(events, midi_sequencer.MIDI_LATENCY)
+    sequencer = midi_sequencer.Sequencer(midi_output=output, midi_time=midi_time, link=LinkInterface(tcp_port=carabiner_port))
+    sequencer.latency_correction = 0.  # notes are due exactly on their step
+
+    compile_pattern = sequencer.compile_pattern
+
+    def report_compile():
+        compile_pattern()
+        events.put(('compiled', time.monotonic() * 1e6))
+    sequencer.compile_pattern = report_compile
+
+    receiver = SampleReceiver(sample_folder)
+    while not stop.is_set():
+        receiver.check_for_timeout(time.time())
+        stop.wait(0.1)
+
+
+class Events:
+    """ Collects what the sampling computer reports """
+    def __init__(self, queue):
+        self.queue = queue
+        self.notes = []  # (note, sounds, written)
+        self.compiled = []
+        self.lock = threading.Lock()
+        threading.Thread(target=self.collect, daemon=True).start()
+
+    def collect(self):
+        while True:
+            event = self.queue.get()
+            with self.lock:
+                if event[0] == 'note':
+                    self.notes.append(event[1:])
+                elif event[0] == 'compiled':
+                    self.compiled.append(event[1])
+
+    def notes_between(self, note, start, stop):
+        with self.lock:
+            return [(sounds, written) for n, sounds, written in self.notes if n == note and start <= sounds < stop]
+
+    def first_compile_after(self, t):
+        with self.lock:
+            return next((compiled for compiled in self.compiled if compiled >= t), None)
+
+
+def wait_for(condition, timeout, what):
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            raise TimeoutError(f"Timed out waiting for {what}")
+        time.sleep(0.01)
+
+
+def stats(values, scale=1.):
+    """ Summary of a list of measurements, divided by scale """
+    if not values:
+        return {'count': 0}
+    values = np.asarray(values, dtype=float) / scale
+    return {'count': len(values), 'mean': float(values.mean()), 'std': float(values.std()),
+            'min': float(values.min()), 'p50': float(np.percentile(values, 50)),
+            'p99': float(np.percentile(values, 99)), 'max': float(values.max())}
+
+
+def start_broker():
+    """ Address of the broker and the process running it: MQTT_BROKER if set, else mosquitto on a free port """
+    if "MQTT_BROKER" in os.environ:
+        return os.environ["MQTT_BROKER"], None
+    mosquitto = shutil.which("mosquitto")
+    if mosquitto is None:
+        sys.exit("Needs mosquitto on the PATH, or MQTT_BROKER set to a running broker")
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    process = subprocess.Popen([mosquitto, "-p", str(port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    end = time.monotonic() + 5.
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1.).close()
+            return f"127.0.0.1:{port}", process
+        except OSError:
+            if time.monotonic() > end:
+                process.kill()
+                sys.exit("mosquitto did not start")
+            time.sleep(0.05)
+
+
+def click_pad(ui, track, step):
+    ui.handle_click(ui.tracks[track].step_rects[step].center)
+
+
+def note_of(track):
+    from midi_sequencer import DEFAULT_NOTE_MAP
+    return DEFAULT_NOTE_MAP[track].note
+
+
+def click_to_note(ui, server, events, clicks, steps_ahead=3):
+    """ Switch on a pad steps_ahead steps ahead of the playhead, see when its note sounds, switch it off again """
+    note = note_of(CLICK_TRACK)
+    propagation, latency, error, missed = [], [], [], 0
+    for _ in range(clicks):
+        now = time.monotonic() * 1e6
+        target = int(np.floor(server.beat_at(now) * STEPS_PER_BEAT)) + steps_ahead
+        due = server.time_at(target / STEPS_PER_BEAT)
+        step_length = server.time_at(1 / STEPS_PER_BEAT) - server.time_at(0)
+
+        click_time = time.monotonic() * 1e6
+        click_pad(ui, CLICK_TRACK, target % ui.nsteps)
+        time.sleep((due - click_time + 2 * step_length) / 1e6)
+
+        compiled = events.first_compile_after(click_time)
+        notes = events.notes_between(note, click_time, due + step_length)
+        if compiled is not None:
+            propagation.append(compiled - click_time)
+        if notes and abs(notes[0][0] - due) < step_length / 2:
+            latency.append(notes[0][0] - click_time)
+            error.append(notes[0][0] - due)
+        else:
+            missed += 1
+
+        click_pad(ui, CLICK_TRACK, target % ui.nsteps)  # off again
+        time.sleep(0.3)
+    return {'clicks': clicks, 'steps_ahead': steps_ahead, 'missed_step': missed,
+            'click_to_pattern_ms': stats(propagation, 1e3), 'click_to_note_ms': stats(latency, 1e3),
+            'note_error_us': stats(error)}
+
+
+def step_timing(ui, server, events, tempos, seconds):
+    """ Every step of the timing track on, error of each note against its step on the fake Carabiner timeline """
+    for step in range(ui.nsteps):
+        click_pad(ui, TIMING_TRACK, step)
+    note = note_of(TIMING_TRACK)
+    results = {}
+    for bpm in tempos:
+        server.set_bpm(bpm)
+        time.sleep(SETTLE_TIME)
+        start = time.monotonic() * 1e6
+        time.sleep(seconds)
+        stop = time.monotonic() * 1e6 - 100e3  # leave out notes that might not be reported yet
+        notes = events.notes_between(note, start, stop)
+        errors = []
+        for sounds, written in notes:
+            step = round(server.beat_at(sounds) * STEPS_PER_BEAT)
+            errors.append(sounds - server.time_at(step / STEPS_PER_BEAT))
+        expected = int(server.beat_at(stop) * STEPS_PER_BEAT) - int(server.beat_at(start) * STEPS_PER_BEAT)
+        results[f"{bpm:g}"] = {'steps_expected': expected, 'notes': len(notes),
+                               'late_writes': sum(written > sounds for sounds, written in notes),
+                               'error_us': stats(errors)}
+    for step in range(ui.nsteps):
+        click_pad(ui, TIMING_TRACK, step)
+    return results
+
+
+def sample_transfer(sampler, session, count, seconds):
+    """ Mono takes from Sampler.send_sample until they are saved on the other side """
+    saved = []
+    session.subscribe("sampling/saved", lambda msg: saved.append(time.monotonic()), qos=1)
+    sample = make_take(seconds, nchannels=1)
+    durations = []
+    for i in range(count):
+        begin = time.monotonic()
+        sampler.send_sample(sample, 0)
+        wait_for(lambda: len(saved) > i, 60., "the sample to be saved")
+        durations.append(saved[i] - begin)
+    return {'samples': count, 'sample_mb': len(sample) / 1e6, 'seconds': stats(durations),
+            'throughput_mb_s': stats([len(sample) / 1e6 / duration for duration in durations])}
+
+
+def git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def main(args):
+    broker, broker_process = start_broker()
+    os.environ["MQTT_BROKER"] = broker  # for the child process as well
+    server = FakeCarabiner(bpm=args.tempos[0])
+    context = multiprocessing.get_context('spawn')
+    queue, stop = context.Queue(), context.Event()
+    sample_folder = tempfile.TemporaryDirectory()
+    child = context.Process(target=sampling_computer, args=(server.port, sample_folder.name, queue, stop), daemon=True)
+    child.start()
+    events = Events(queue)
+
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            import mqtt_session
+            import sequencer
+            from sampler import Sampler
+
+            ui = sequencer.Sequencer(0, 0, 1280, 800)  # as on the tablet, not drawn
+            sampler = Sampler(link=None)
+            wait_for(lambda: ui.clock is not None, 30., "the clock anchor of the midi_sequencer")
+
+            results = {
+                'version': git_version(), 'python': platform.python_version(), 'platform': platform.platform(),
+                'time': time.strftime("%Y-%m-%dT%H:%M:%S%z"), 'broker': broker,
+                'click_to_note': click_to_note(ui, server, events, args.clicks),
+                'step_timing': step_timing(ui, server, events, args.tempos, args.seconds),
+                'sample_transfer': sample_transfer(sampler, mqtt_session.get_session("benchmark"), args.samples,
+                                                   args.sample_seconds),
+            }
+    finally:
+        stop.set()
+        child.join(5.)
+        server.close()
+        if broker_process is not None:
+            broker_process.terminate()
+        sample_folder.cleanup()
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end latency and throughput with local stand-ins")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    parser.add_argument("--seconds", type=float, default=10., help="step timing run per tempo (s)")
+    parser.add_argument("--tempos", type=float, nargs='+', default=[120., 90., 180.], help="BPM, the first one also for the clicks")
+    parser.add_argument("--clicks", type=int, default=20, help="pad clicks for the click to note latency")
+    parser.add_argument("--samples", type=int, default=5, help="samples sent for the transfer throughput")
+    parser.add_argument("--sample-seconds", type=float, default=10., help="length of each sample (s)")
+    main(parser.parse_args())
@@ -0,0 +1,135 @@
+"""
+A local stand-in for Carabiner, speaking enough of its protocol for LinkInterface:
+status, bpm, beat-at-time, time-at-beat and phase-at-time, all on one steady timeline.
+
+Replies are newline terminated EDN maps like the real ones. The server can also blast out
+status messages at a given rate, cut into randomly sized writes, to stress the client's framing.
+"""
+import socket
+import threading
+import time
+import random
+
+
+def now():
+    """ Same clock as LinkInterface.now, in µs """
+    return int(time.monotonic() * 1000 * 1000)
+
+
+class FakeCarabiner:
+    def __init__(self, host='127.0.0.1', port=0, bpm=120., peers=0):
+        self.bpm = bpm
+        self.peers = peers
+        self.start = now()  # Link time of beat 0
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen()
+        self.host, self.port = self.server.getsockname()
+
+        self.clients = []
+        self.clients_lock = threading.Lock()
+        self.commands_received = 0
+        self.running = True
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    # timeline
+    def beat_at(self, t):
+        return (t - self.start) * self.bpm / 60e6
+
+    def time_at(self, beat):
+        return int(self.start + beat * 60e6 / self.bpm)
+
+    def set_bpm(self, bpm):
+        """ Change tempo without a jump in the current beat, like Link does """
+        t = now()
+        beat = self.beat_at(t)
+        self.bpm = bpm
+        self.start = int(t - beat * 60e6 / bpm)
+
+    # protocol
+    def status_message(self, beat=None):
+        if beat is None:
+            beat = self.beat_at(now())
+        return f"status {{:peers {self.peers} :bpm {float(self.bpm)} :start {self.start} :beat {beat}}}\n".encode()
+
+    def reply(self, command):
+        """ The response to one command, like Carabiner an error reply for unknown commands or bad arguments """
+        name, *args = command.split()
+        try:
+            if name == 'status':
+                return self.status_message()
+            if name == 'bpm':
+                self.set_bpm(float(args[0]))
+                return self.status_message()
+            if name == 'beat-at-time':
+                when, quantum = int(args[0]), float(args[1])
+                return f"beat-at-time {{:when {when} :quantum {quantum} :beat {self.beat_at(when)}}}\n".encode()
+            if name == 'phase-at-time':
+                when, quantum = int(args[0]), float(args[1])
+                return f"phase-at-time {{:when {when} :quantum {quantum} :phase {self.beat_at(when) % quantum}}}\n".encode()
+            if name == 'time-at-beat':
+                beat, quantum = float(args[0]), float(args[1])
+                return f"time-at-beat {{:beat {beat} :quantum {quantum} :when {self.time_at(beat)}}}\n".encode()
+        except (IndexError, ValueError):
+            return f"bad-args {{:command \"{name}\" :args \"{' '.join(args)}\"}}\n".encode()
+        return f"unsupported {name}\n".encode()
+
+    def _accept(self):
+        while self.running:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                break
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.clients_lock:
+                self.clients.append(conn)
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        while self.running:
+            try:
+                data = conn.recv(4096)
+            except OSError:
+                break
+            if not data:
+                break
+            # real Carabiner takes one command per read, newline separated ones are accepted as well
+            for command in data.split(b'\n'):
+                if not command.strip():
+                    continue
+                self.commands_received += 1
+                response = self.reply(command.decode(errors='replace'))
+                with self.clients_lock:
+                    conn.sendall(response)
+
+    def blast(self, count, rate=None, max_write=4096):
+        """
+        Send `count` status messages to every client, with beat = sequence number, so that the
+        receiver can check that none got lost. Writes are cut at random positions, so messages get
+        split across and merged within reads. With rate (messages per second) the sending is paced.
+        """
+        stream = b''.join(self.status_message(beat=float(i)) for i in range(count))
+        sent = 0
+        messages_sent = 0
+        begin = time.perf_counter()
+        while sent < len(stream):
+            size = random.randint(1, max_write)
+            with self.clients_lock:
+                for conn in self.clients:
+                    conn.sendall(stream[sent:sent + size])
+            messages_sent += stream.count(b'\n', sent, sent + size)
+            sent += size
+            if rate is not None:
+                messages_due = rate * (time.perf_counter() - begin)
+                if messages_sent > messages_due:
+                    time.sleep((messages_sent - messages_due) / rate)
+        return time.perf_counter() - begin
+
+    def close(self):
+        self.running = False
+        self.server.close()
+        with self.clients_lock:
+            for conn in self.clients:
+                conn.close()
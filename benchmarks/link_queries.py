@@ -0,0 +1,83 @@
+"""
+Query rate of LinkInterface's request/response API against a local fake Carabiner.
+
+Every query is answered and checked: sequential blocking queries (one round trip each),
+pipelined batches (one socket write per batch) and concurrent asyncio queries. A last run mixes
+malformed commands into the batches: each of them must fail on its own error reply, and every
+valid query after it must still get its own reply.
+
+Run from the repository root:
+    python -m benchmarks.link_queries [count] [batch]
+"""
+import sys
+import time
+import asyncio
+
+from LinkToPie import LinkInterface
+from benchmarks.fake_carabiner import FakeCarabiner
+
+
+def check(reply, beat):
+    assert reply['beat'] == beat, f"reply for beat {reply['beat']} instead of {beat}"
+
+
+def sequential(link, count):
+    for i in range(count):
+        check(link.query('time-at-beat', float(i), 4), float(i))
+
+
+def pipelined(link, count, batch):
+    for first in range(0, count, batch):
+        with link.pipeline():
+            futures = [link.request('time-at-beat', float(i), 4) for i in range(first, min(first + batch, count))]
+        for i, future in enumerate(futures, first):
+            check(future.result(timeout=5.), float(i))
+
+
+def concurrent_async(link, count, batch):
+    async def run():
+        for first in range(0, count, batch):
+            beats = [float(i) for i in range(first, min(first + batch, count))]
+            with link.pipeline():
+                queries = [asyncio.ensure_future(link.query_async('time-at-beat', beat, 4, timeout=5.)) for beat in beats]
+                await asyncio.sleep(0)  # let the tasks make their requests inside the pipeline
+            for beat, reply in zip(beats, await asyncio.gather(*queries)):
+                check(reply, beat)
+    asyncio.run(run())
+
+
+def with_errors(link, count, batch, every=10):
+    """ Pipelined, with every `every`th query missing its quantum, which Carabiner answers with bad-args """
+    for first in range(0, count, batch):
+        beats = range(first, min(first + batch, count))
+        with link.pipeline():
+            futures = [link.request('time-at-beat', *([float(i)] if i % every == 0 else [float(i), 4])) for i in beats]
+        for i, future in zip(beats, futures):
+            if i % every == 0:
+                assert isinstance(future.exception(timeout=5.), RuntimeError), f"malformed query {i} did not fail"
+            else:
+                check(future.result(timeout=5.), float(i))
+    check(link.query('time-at-beat', float(count), 4), float(count))
+
+
+def main(count=5000, batch=100):
+    server = FakeCarabiner()
+    link = LinkInterface(tcp_port=server.port)
+
+    runs = [("sequential", lambda: sequential(link, count)),
+            (f"pipelined x{batch}", lambda: pipelined(link, count, batch)),
+            (f"asyncio x{batch}", lambda: concurrent_async(link, count, batch)),
+            (f"errors x{batch}", lambda: with_errors(link, count, batch))]
+    print(f"{count} time-at-beat queries")
+    for name, run in runs:
+        begin = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - begin
+        print(f"{name:<16}{elapsed:>8.2f} s {count / elapsed:>10.0f} queries/s")
+
+    link.close()
+    server.close()
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
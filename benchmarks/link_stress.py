@@ -0,0 +1,58 @@
+"""
+Stress test of LinkInterface's message framing against a local fake Carabiner.
+
+The fake server sends thousands of status messages per second, cut into random writes so that
+TCP splits and merges them arbitrarily. Every message carries its sequence number as the beat,
+the status callback checks that all of them arrive, in order, and that none fails to parse.
+
+Run from the repository root (exits with status 1 on any loss):
+    python -m benchmarks.link_stress [count] [rate]
+"""
+import sys
+import time
+import threading
+
+from LinkToPie import LinkInterface
+from benchmarks.fake_carabiner import FakeCarabiner
+
+
+def main(count=20000, rate=5000.):
+    server = FakeCarabiner()
+    received = []
+    all_arrived = threading.Event()
+
+    def on_status(msg):
+        received.append(int(msg['beat']))
+        if len(received) == count:
+            all_arrived.set()
+
+    link = LinkInterface(tcp_port=server.port, callbacks={'status': on_status})
+    while not server.clients:  # wait for the connection to be accepted
+        time.sleep(0.01)
+
+    print(f"Sending {count} status messages at {rate:.0f}/s in randomly cut writes")
+    begin = time.perf_counter()
+    send_time = server.blast(count, rate=rate)
+    # the client may lag behind, wait as long as it makes progress
+    while not all_arrived.wait(timeout=2.):
+        backlog = count - len(received)
+        time.sleep(0.5)
+        if count - len(received) == backlog:
+            break
+    receive_time = time.perf_counter() - begin
+    link.close()
+    server.close()
+
+    lost = count - len(received)
+    in_order = received == list(range(len(received)))
+    print(f"sent in {send_time:.2f} s ({count / send_time:.0f} msg/s), handled in {receive_time:.2f} s "
+          f"({len(received) / receive_time:.0f} msg/s)")
+    print(f"received {len(received)}, lost {lost}, parse errors {link.parse_errors}, in order: {in_order}")
+    return lost == 0 and link.parse_errors == 0 and in_order
+
+
+if __name__ == "__main__":
+    args = [int(sys.argv[1])] if len(sys.argv) > 1 else []
+    if len(sys.argv) > 2:
+        args.append(float(sys.argv[2]))
+    sys.exit(0 if main(*args) else 1)
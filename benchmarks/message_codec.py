@@ -0,0 +1,81 @@
+"""
+Encode/decode time and wire size of the control messages: the binary schemas of message_codec,
+its JSON fallback and the JSON with sender names that was sent before.
+
+Every message type is timed over many round trips. At the rate it is sent during a session
+(faders while dragging, at MAX_PUBLISH_RATE) this gives the bytes per second on the wire and the CPU
+time per second it costs the sender and each receiver.
+
+Run from the repository root:
+    python -m benchmarks.message_codec [round trips]
+"""
+import sys
+import json
+import time
+
+import message_codec
+from mqtt_client import MAX_PUBLISH_RATE
+from pattern_state import PatternState
+
+NAME = "live_sequencer"
+SENDER = message_codec.sender_id(NAME)
+
+
+def pattern_snapshot(ntracks=4, nsteps=16):
+    state = PatternState(ntracks, nsteps, writer=SENDER)
+    for track in range(ntracks):
+        for step in range(0, nsteps, track + 2):
+            state.local_edit(track, step, 1)
+    return dict(state.snapshot(), sender_id=SENDER)
+
+
+def messages():
+    """ (topic, message, messages per second) of every message type """
+    edit = PatternState(4, 16, writer=SENDER).local_edit(2, 5, 1)
+    return [
+        ("sequencer/clock", {'sender_id': SENDER, 'beat': 1234.56789, 'time': time.time() * 1e6, 'bpm': 120.,
+                             'steps_per_beat': 4, 'nsteps': 16}, 1.),
+        ("sequencer/edit", dict(edit, sender_id=SENDER), 10.),
+        ("sequencer/state", pattern_snapshot(), 1.),
+        ("sampling", {'sender_id': SENDER, 'state': {'source': 2, 'sync': 1, 'record_pressed': 1}}, 1.),
+        ("myChannel", {'sender_id': SENDER, 'val': 87}, MAX_PUBLISH_RATE),
+        ("faders", {'sender_id': SENDER, 'values': list(range(0, 128, 8))}, MAX_PUBLISH_RATE),
+    ]
+
+
+def legacy_json(msg):
+    """ The message as it was sent before, with the sender's name """
+    legacy = dict(msg, sender_id=NAME)
+    if 'writer' in legacy:
+        legacy['writer'] = NAME
+    if 'versions' in legacy:
+        legacy['versions'] = [[[version, NAME] for version, writer in row] for row in legacy['versions']]
+    return legacy
+
+
+def time_per_call(function, arg, count):
+    begin = time.perf_counter()
+    for _ in range(count):
+        function(arg)
+    return (time.perf_counter() - begin) / count * 1e6
+
+
+def main(count=20000):
+    print(f"{count} round trips per message type and format")
+    print(f"{'topic':<17}{'format':<13}{'msg/s':>7}{'bytes':>7}{'enc µs':>9}{'dec µs':>9}{'bytes/s':>10}{'cpu µs/s':>10}")
+    for topic, msg, rate in messages():
+        formats = [("json (names)", lambda m: json.dumps(legacy_json(m)), json.loads),
+                   ("json", lambda m: message_codec.encode(topic, m, use_json=True), message_codec.decode),
+                   ("binary", lambda m: message_codec.encode(topic, m, use_json=False), message_codec.decode)]
+        for name, encode, decode in formats:
+            payload = encode(msg)
+            if name != "json (names)":
+                assert decode(payload) == msg, f"{topic} {name} round trip changed the message"
+            encode_us = time_per_call(encode, msg, count)
+            decode_us = time_per_call(decode, payload, count)
+            print(f"{topic:<17}{name:<13}{rate:>7.0f}{len(payload):>7}{encode_us:>9.2f}{decode_us:>9.2f}"
+                  f"{len(payload) * rate:>10.0f}{(encode_us + decode_us) * rate:>10.1f}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,45 @@
+"""
+Cost of finding the notes of one step: the old loop over the nested state lists, building MidiNote
+tuples and MIDI messages on every step, against the lookup in a CompiledPattern.
+
+Run from the repository root:
+    python -m benchmarks.pattern_step
+"""
+import timeit
+import numpy as np
+
+from midi_sequencer import MidiNote, CompiledPattern
+
+GRIDS = [(4, 8), (16, 16), (64, 64)]  # tracks x steps
+
+
+def legacy_step(state, midi_notes, ntracks, step):
+    notes_on_list = []
+    for track_id in range(ntracks):
+        if state[track_id][step]:
+            notes_on_list.append(midi_notes[track_id])
+    return [[0x90 + note.channel, note.note, 64] for note in notes_on_list]
+
+
+def main(repeats=20000):
+    rng = np.random.default_rng(0)
+    print(f"{'grid':<10}{'legacy µs':>11}{'compiled µs':>13}{'compile ms':>12}")
+    for ntracks, nsteps in GRIDS:
+        state = (rng.random((ntracks, nsteps)) < 0.25).astype(int).tolist()
+        note_map = [MidiNote(channel=9, note=36 + track % 64) for track in range(ntracks)]
+
+        compile_time = min(timeit.repeat(lambda: CompiledPattern(state, note_map), number=10, repeat=3)) / 10
+        pattern = CompiledPattern(state, note_map)
+        for step in range(nsteps):
+            assert [list(m) for m in pattern.messages(step)] == legacy_step(state, note_map, ntracks, step)
+
+        counter = iter(range(10 ** 9))
+        legacy = min(timeit.repeat(lambda: legacy_step(state, note_map, ntracks, next(counter) % nsteps),
+                                   number=repeats, repeat=3))
+        compiled = min(timeit.repeat(lambda: pattern.messages(next(counter)), number=repeats, repeat=3))
+        print(f"{f'{ntracks}x{nsteps}':<10}{legacy / repeats * 1e6:>11.2f}{compiled / repeats * 1e6:>13.2f}"
+              f"{compile_time * 1e3:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Compression ratio against encode/decode time for the sample codecs.
+
+A 30 second mono take is sent through sample_protocol with every codec and a range of levels.
+Besides ratio and speed, the estimated end-to-end transfer time is reported for a given network
+bandwidth (encode + wire size / bandwidth + decode, i.e. without any overlap from streaming),
+which is the number to look at when picking a setting for a congested network.
+
+Run from the repository root, optionally with a mono 16 bit .wav file to use instead of the synthetic take
+and the network bandwidth in MB/s:
+    python -m benchmarks.sample_codec [--wav take.wav] [--bandwidth 1.0]
+"""
+import argparse
+import time
+import wave
+import numpy as np
+
+import sample_protocol
+import sample_codec
+
+SAMPLERATE = 44100
+DURATION = 30.  # seconds
+LEVELS = {"zlib": [1, 6, 9], "lzma": [0, 3, 6]}
+
+
+def make_take(duration=DURATION, samplerate=SAMPLERATE):
+    """ Plucked notes with decaying harmonics every half second over a quiet noise floor """
+    rng = np.random.default_rng(0)
+    signal = 1e-3 * rng.standard_normal(int(duration * samplerate))
+    note_length = samplerate // 2
+    t = np.arange(note_length) / samplerate
+    for start in range(0, len(signal) - note_length, note_length):
+        f0 = 110. * 2 ** (rng.integers(0, 24) / 12)
+        note = sum(np.sin(2 * np.pi * k * f0 * t) / k for k in range(1, 6)) * np.exp(-6 * t)
+        signal[start:start + note_length] += 0.3 * note
+    return (np.clip(signal, -1, 1) * 32767).astype('<i2').tobytes()
+
+
+def load_wav(path):
+    with wave.open(path, 'rb') as wfile:
+        if wfile.getnchannels() != 1 or wfile.getsampwidth() != 2:
+            raise ValueError("Only mono 16 bit files are supported")
+        return wfile.readframes(wfile.getnframes())
+
+
+def measure(codec, sample):
+    sample_id = sample_protocol.new_sample_id()
+    start = time.perf_counter()
+    payloads = list(sample_protocol.binary_chunks(sample, sample_id, 0, codec=codec))
+    encoded = time.perf_counter()
+    decoded_chunks = [sample_protocol.decode(payload).data for payload in payloads]
+    decoded = time.perf_counter()
+
+    assert b''.join(decoded_chunks) == sample, f"{codec.name} is not lossless"
+    return sum(len(p) for p in payloads), encoded - start, decoded - encoded
+
+
+def main(sample, bandwidth):
+    size_mb = len(sample) / 1e6
+    print(f"{len(sample) / 2 / SAMPLERATE:.1f} s mono take, {size_mb:.2f} MB of PCM, network at {bandwidth} MB/s")
+    print(f"{'codec':<14}{'level':>6}{'ratio':>8}{'enc MB/s':>10}{'dec MB/s':>10}{'transfer s':>12}")
+
+    settings = [("raw", None)]
+    for name in sample_codec.CODEC_NAMES[1:]:
+        settings += [(name, level) for level in LEVELS[name.split("-")[1]]]
+
+    for name, level in settings:
+        codec = sample_codec.make_codec(name, level)
+        wire_bytes, encode_time, decode_time = measure(codec, sample)
+        transfer_time = encode_time + wire_bytes / 1e6 / bandwidth + decode_time
+        print(f"{name:<14}{'' if level is None else level:>6}{len(sample) / wire_bytes:>8.2f}"
+              f"{size_mb / encode_time:>10.1f}{size_mb / decode_time:>10.1f}{transfer_time:>12.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--wav", help="mono 16 bit .wav file to compress instead of the synthetic take")
+    parser.add_argument("--bandwidth", type=float, default=1.0, help="network bandwidth in MB/s")
+    args = parser.parse_args()
+
+    main(load_wav(args.wav) if args.wav else make_take(), args.bandwidth)
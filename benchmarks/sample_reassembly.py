@@ -0,0 +1,111 @@
+"""
+Memory and time of reassembling incoming samples on the sampling computer.
+
+For 1, 5 and 20 minute mono takes, all chunks are fed through the receiver's SampleAssembly (preallocated
+buffer, chunks written in place) and through the original approach (dict of decoded chunks, joined with
+repeated bytes concatenation). Each run happens in a fresh subprocess, so that the peak RSS it reports
+belongs to that run alone. The original approach is skipped for 20 minutes, its quadratic copying
+takes far too long there.
+
+Linux only (peak RSS from getrusage). Run from the repository root:
+    python -m benchmarks.sample_reassembly
+"""
+import sys
+import time
+import resource
+import subprocess
+
+import sample_protocol
+import sample_codec
+from sample_receiver import SampleAssembly
+
+SAMPLERATE = 44100
+CHUNK_KB = sample_protocol.DEFAULT_CHUNK_KB
+DURATIONS = [1, 5, 20]  # minutes
+LEGACY_MAX_MINUTES = 5
+
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # ru_maxrss is in kB on Linux
+
+
+def incoming_messages(sample_length, streamed):
+    """ Messages as they would come from the broker, generated one at a time so the sender side uses no memory """
+    sample_id = sample_protocol.new_sample_id()
+    chunksize = sample_protocol.chunk_size_bytes(CHUNK_KB)
+    pattern = bytes(range(256)) * (chunksize // 256 + 1)
+    if streamed:
+        stream = sample_protocol.SampleStream(sample_id, 0, chunk_kb=CHUNK_KB)
+        for offset in range(0, sample_length, chunksize):
+            yield from stream.feed(pattern[:min(chunksize, sample_length - offset)])
+        yield from stream.finish()
+    else:
+        num_chunks = -(-sample_length // chunksize)
+        for i in range(num_chunks):
+            data = pattern[:min(chunksize, sample_length - i * chunksize)]
+            header = sample_protocol.HEADER.pack(sample_protocol.MAGIC, sample_protocol.PROTOCOL_VERSION, sample_protocol.KIND_DATA,
+                                                 sample_id, i, num_chunks, chunksize, sample_length, 0, sample_codec.CODEC_RAW)
+            yield header + data
+
+
+def reassemble_preallocated(messages):
+    assembly = None
+    for payload in messages:
+        chunk = sample_protocol.decode(payload)
+        if assembly is None:
+            assembly = SampleAssembly(chunk, time.time())
+        assembly.add(chunk, time.time())
+    assert assembly.is_complete()
+    sample = assembly.getbuffer()
+    length = len(sample)
+    sample.release()
+    assembly.data.close()
+    return length
+
+
+def reassemble_legacy(messages):
+    sample_chunks = {}
+    num_chunks = 0
+    for payload in messages:
+        chunk = sample_protocol.decode(payload)
+        sample_chunks[chunk.chunk_index] = bytes(chunk.data)
+        num_chunks = chunk.num_chunks
+    sample = b''
+    for i in range(num_chunks):
+        sample += sample_chunks[i]
+    return len(sample)
+
+
+def run_child(minutes, method):
+    sample_length = int(minutes * 60 * SAMPLERATE) * 2
+    rss_before = peak_rss()
+    start = time.perf_counter()
+    if method == 'legacy':
+        length = reassemble_legacy(incoming_messages(sample_length, streamed=False))
+    else:
+        length = reassemble_preallocated(incoming_messages(sample_length, streamed=(method == 'streamed')))
+    elapsed = time.perf_counter() - start
+    assert length == sample_length
+    print(f"{elapsed} {peak_rss() - rss_before} {sample_length}")
+
+
+def main():
+    print(f"{'minutes':>8}{'method':>14}{'sample MB':>11}{'time s':>9}{'peak RSS MB':>13}{'RSS/size':>10}")
+    for minutes in DURATIONS:
+        methods = ['preallocated', 'streamed']
+        if minutes <= LEGACY_MAX_MINUTES:
+            methods.insert(0, 'legacy')
+        for method in methods:
+            output = subprocess.run([sys.executable, "-m", "benchmarks.sample_reassembly", "--child", str(minutes), method],
+                                    check=True, capture_output=True, text=True).stdout
+            elapsed, rss, sample_length = output.split()
+            rss, sample_length = int(rss), int(sample_length)
+            print(f"{minutes:>8}{method:>14}{sample_length / 2**20:>11.1f}{float(elapsed):>9.3f}"
+                  f"{rss / 2**20:>13.1f}{rss / sample_length:>10.2f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        run_child(float(sys.argv[2]), sys.argv[3])
+    else:
+        main()
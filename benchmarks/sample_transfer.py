@@ -0,0 +1,75 @@
+"""
+Compare the binary sample transfer format against the legacy base64-in-JSON chunks.
+
+Encodes and decodes a 30 second stereo take in both formats (without a broker in between)
+and reports wire size, number of messages, wall time and CPU time on both ends.
+
+Run from the repository root:
+    python -m benchmarks.sample_transfer [chunk_kb]
+"""
+import sys
+import time
+import numpy as np
+
+import sample_protocol
+
+SAMPLERATE = 44100
+DURATION = 30.  # seconds
+NCHANNELS = 2
+
+
+def make_take(duration=DURATION, nchannels=NCHANNELS, samplerate=SAMPLERATE):
+    """ A noisy sine as interleaved int16 PCM, as it comes from the audio device """
+    t = np.arange(int(duration * samplerate)) / samplerate
+    rng = np.random.default_rng(0)
+    signal = 0.5 * np.sin(2 * np.pi * 220. * t)[:, None] + 0.05 * rng.standard_normal((len(t), nchannels))
+    return (np.clip(signal, -1, 1) * 32767).astype('<i2').tobytes()
+
+
+def measure(encode, sample):
+    """ Run encode and decode of all chunks, return a dict of measurements """
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    payloads = list(encode(sample))
+    wall_encoded, cpu_encoded = time.perf_counter(), time.process_time()
+
+    chunks = {}
+    for payload in payloads:
+        chunk = sample_protocol.decode(payload)
+        chunks[chunk.chunk_index] = chunk.data
+    decoded = b''.join(chunks[i] for i in range(len(chunks)))
+    wall_decoded, cpu_decoded = time.perf_counter(), time.process_time()
+
+    assert decoded == sample, "round trip changed the sample"
+    wire_bytes = sum(len(p) for p in payloads)
+    return {
+        'messages': len(payloads),
+        'wire_bytes': wire_bytes,
+        'overhead': wire_bytes / len(sample) - 1.,
+        'encode_wall': wall_encoded - wall_start,
+        'encode_cpu': cpu_encoded - cpu_start,
+        'decode_wall': wall_decoded - wall_encoded,
+        'decode_cpu': cpu_decoded - cpu_encoded,
+        'throughput_mb_s': len(sample) / 1e6 / (wall_decoded - wall_start),
+    }
+
+
+def main(chunk_kb=sample_protocol.DEFAULT_CHUNK_KB):
+    sample = make_take()
+    print(f"{DURATION:.0f} s stereo take, {len(sample) / 1e6:.2f} MB of PCM")
+
+    results = {
+        'json (legacy)': measure(lambda s: sample_protocol.json_chunks(s, 1, 0, "sampler"), sample),
+        f'binary ({chunk_kb} kB)': measure(lambda s: sample_protocol.binary_chunks(s, sample_protocol.new_sample_id(), 0, chunk_kb=chunk_kb), sample),
+    }
+
+    print(f"{'format':<20}{'msgs':>8}{'wire MB':>10}{'overhead':>10}{'enc cpu s':>11}{'dec cpu s':>11}{'MB/s':>9}")
+    for name, r in results.items():
+        print(f"{name:<20}{r['messages']:>8}{r['wire_bytes'] / 1e6:>10.2f}{r['overhead']:>10.1%}"
+              f"{r['encode_cpu']:>11.3f}{r['decode_cpu']:>11.3f}{r['throughput_mb_s']:>9.1f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(float(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,61 @@
+"""
+Step timing of the midi_sequencer scheduler against a local fake Carabiner, at several tempos with 16th note steps.
+
+For each tempo the deadline scheduler (sleep, then spin the final stretch) is compared with the old
+approach of polling the current step every 10 ms. Lateness is how long after the step's exact
+time on the Link timeline it fired.
+
+Run from the repository root:
+    python -m benchmarks.step_jitter [seconds per run]
+"""
+import sys
+import time
+import threading
+
+from LinkToPie import LinkInterface
+from midi_sequencer import StepScheduler, LatenessHistogram
+from benchmarks.fake_carabiner import FakeCarabiner
+
+TEMPOS = [120., 180.]
+STEPS_PER_BEAT = 4
+
+
+def poll_10ms(link, duration):
+    """ The previous step loop: check every 10 ms whether a new step has started """
+    lateness = LatenessHistogram()
+    last_step = None
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        t = link.now()
+        step = int(link.timeline.beat_at(t) * STEPS_PER_BEAT)
+        if last_step is not None and step > last_step:
+            lateness.add(t - link.timeline.time_at_beat(step / STEPS_PER_BEAT))
+        last_step = step
+        time.sleep(0.01)
+    return lateness
+
+
+def deadline_scheduler(link, duration):
+    scheduler = StepScheduler(link, lambda step: None, STEPS_PER_BEAT)
+    thread = threading.Thread(target=scheduler.run, daemon=True)
+    thread.start()
+    time.sleep(duration)
+    scheduler.running = False
+    thread.join()
+    return scheduler.lateness
+
+
+def main(duration=10.):
+    server = FakeCarabiner()
+    link = LinkInterface(tcp_port=server.port)
+    for bpm in TEMPOS:
+        link.query('bpm', bpm)
+        print(f"{bpm:.0f} BPM, {STEPS_PER_BEAT} steps per beat, {duration:.0f} s per run")
+        for name, run in [("poll 10 ms", poll_10ms), ("deadline", deadline_scheduler)]:
+            print(f"  {name:<12}{run(link, duration).summary()}")
+    link.close()
+    server.close()
+
+
+if __name__ == "__main__":
+    main(*(float(arg) for arg in sys.argv[1:2]))
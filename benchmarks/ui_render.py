@@ -0,0 +1,133 @@
+"""
+Frame time of the UI widgets with the render cache against drawing everything from scratch
+(font lookup, label rendering and shape drawing on every frame, as the widgets used to).
+
+Runs headless with the SDL dummy video driver. Besides the timings it checks that the cached
+drawing gives the same pixels as the old one.
+
+Run from the repository root:
+    python -m benchmarks.ui_render [frames]
+"""
+import os
+import sys
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+import pygame.gfxdraw
+
+from ui_widgets import TransportWidget, LatencyNudgeWidget, render_cache
+from sequencer import SequencerTrack
+
+WIDTH, HEIGHT = 1280, 800
+
+
+def legacy_transport_draw(widget, screen):
+    """ TransportWidget.draw and draw_labels before the render cache """
+    screen.fill((0, 0, 0), widget.bounding_rect)
+    for rects, labels, state, color in [(widget.source_button_rects, widget.source_labels, widget.source_state, (0, 0, 255)),
+                                        (widget.sync_button_rects, widget.sync_labels, widget.sync_state, (0, 255, 0))]:
+        for i, button_rect in enumerate(rects):
+            pygame.draw.rect(screen, color if state == i else (0, 0, 0), button_rect)
+            pygame.draw.rect(screen, (255, 255, 255), button_rect, 2)
+    font = pygame.font.SysFont('Arial', widget.font_size)
+    for rects, labels, state, color in [(widget.source_button_rects, widget.source_labels, widget.source_state, (0, 0, 255)),
+                                        (widget.sync_button_rects, widget.sync_labels, widget.sync_state, (0, 255, 0))]:
+        for i, label in enumerate(labels):
+            text_surface = font.render(label, True, (255, 255, 255, 255), color if state == i else (0, 0, 0))
+            textrect = text_surface.get_rect()
+            textrect.centerx = rects[i].x + rects[i].width / 2
+            textrect.centery = rects[i].y + rects[i].height / 2
+            screen.blit(text_surface, textrect)
+    icon = widget.rec_stop_icon_rect
+    if widget.rec_state == 0:
+        pygame.draw.rect(screen, (0, 0, 0), widget.rec_stop_rect)
+        pygame.draw.rect(screen, (255, 255, 255), widget.rec_stop_rect, 2)
+        pygame.gfxdraw.filled_circle(screen, icon.centerx, icon.centery, widget.icon_width//2, (255, 0, 0))
+        pygame.gfxdraw.aacircle(screen, icon.centerx, icon.centery, widget.icon_width//2, (255, 0, 0))
+    else:
+        pygame.draw.rect(screen, (255, 0, 0), widget.rec_stop_rect)
+        pygame.draw.rect(screen, (255, 255, 255), widget.rec_stop_rect, 2)
+        pygame.draw.rect(screen, (255, 255, 255), icon)
+
+
+def legacy_track_draw(track, screen):
+    """ SequencerTrack.draw before dirty pads and the render cache """
+    screen.fill((0, 0, 0), track.bounding_rect)
+    for i in range(track.nsteps):
+        if track.state[i]:
+            pygame.draw.rect(screen, (0, 255, 0), track.step_rects[i])
+        if i == track.step:
+            pygame.draw.rect(screen, (0, 0, 255), track.step_rects[i])
+        pygame.draw.rect(screen, (255, 255, 255), track.step_rects[i], 1)
+
+
+def cycle_transport(widget, frame):
+    widget.source_state, widget.sync_state, widget.rec_state = frame % 4, frame % 3, (frame // 12) % 2
+
+
+def time_frames(frames, draw):
+    begin = time.perf_counter()
+    for frame in range(frames):
+        draw(frame)
+    return (time.perf_counter() - begin) / frames * 1e6
+
+
+def main(frames=500):
+    pygame.init()
+    screen = pygame.display.set_mode((WIDTH, HEIGHT))
+    reference = pygame.Surface((WIDTH, HEIGHT))
+
+    transport = TransportWidget(100, 200, WIDTH - 200, HEIGHT - 500, offline=True)
+    for frame in range(24):  # every state, and check the pixels
+        cycle_transport(transport, frame)
+        legacy_transport_draw(transport, reference)
+        transport.draw(screen, force=True)
+        assert pygame.image.tostring(screen, "RGB") == pygame.image.tostring(reference, "RGB"), "transport differs"
+
+    tracks = [SequencerTrack(0, i * HEIGHT // 4, WIDTH, HEIGHT // 4, nsteps=8) for i in range(4)]
+    for i, track in enumerate(tracks):
+        track.state = [(step + i) % 3 == 0 for step in range(8)]
+
+    def cached_tracks(frame, force):
+        for track in tracks:
+            track.step = frame % 8
+            if force:
+                track.drawn = None
+            track.draw(screen)
+
+    def legacy_tracks(frame):
+        for track in tracks:
+            track.step = frame % 8
+            legacy_track_draw(track, screen)
+
+    nudge = LatencyNudgeWidget(50, 100, 300, 200)
+
+    def legacy_nudge(frame):
+        render_cache.surfaces.clear()
+        nudge.draw(screen)
+
+    def cycled(frame):
+        cycle_transport(transport, frame)
+        transport.draw(screen, force=True)
+
+    runs = [
+        ("transport", "legacy, every frame", lambda frame: (cycle_transport(transport, frame), legacy_transport_draw(transport, screen))),
+        ("transport", "cached, every frame", cycled),
+        ("transport", "cached, unchanged", lambda frame: transport.draw(screen)),
+        ("4x8 pads", "legacy, every frame", legacy_tracks),
+        ("4x8 pads", "cached, every pad", lambda frame: cached_tracks(frame, True)),
+        ("4x8 pads", "cached, changed pads", lambda frame: cached_tracks(frame, False)),
+        ("nudge", "composed every frame", legacy_nudge),
+        ("nudge", "cached", lambda frame: nudge.draw(screen)),
+    ]
+    print(f"{frames} frames at {WIDTH}x{HEIGHT}")
+    print(f"{'widget':<11}{'drawing':<24}{'µs/frame':>10}")
+    for widget, name, draw in runs:
+        print(f"{widget:<11}{name:<24}{time_frames(frames, draw):>10.1f}")
+    pygame.quit()
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,69 @@
+"""
+Decoder for the messages Carabiner sends, e.g.
+    status {:peers 0 :bpm 120.0 :start 73743731220 :beat 597.2209362897765}
+
+Carabiner only ever replies with a message type followed by a flat EDN map of keywords to numbers
+(status, beat-at-time, phase-at-time, time-at-beat, ...). Those are decoded straight from the bytes
+into a plain dict with string keys. Anything else falls back to the general edn_format parser,
+which is only imported when it is actually needed.
+"""
+
+_ATOMS = {b'true': True, b'false': False, b'nil': None}
+_NOT_FLAT = (b'{', b'[', b'(', b'"', b'#', b'\\', b',', b';')  # anything beyond a flat map of plain values
+
+_keys = {}  # b':bpm' -> 'bpm', the few keys Carabiner uses are decoded only once
+
+
+def _key(token):
+    key = _keys.get(token)
+    if key is None:
+        if len(token) < 2 or token[0] != 0x3a:  # ':'
+            raise ValueError(f"Not a keyword: {token!r}")
+        key = _keys[token] = token[1:].decode('ascii')
+    return key
+
+
+def _value(token):
+    atom = _ATOMS.get(token, token)
+    if atom is not token:
+        return atom
+    if b'.' in token or b'e' in token or b'E' in token:
+        return float(token)
+    return int(token)
+
+
+def decode_flat_map(body):
+    """ Decode b'{:key value ...}' with only numbers and true/false/nil as values, raise ValueError otherwise """
+    if body[:1] != b'{' or body[-1:] != b'}':
+        raise ValueError("Not a map")
+    inner = body[1:-1]
+    if any(c in inner for c in _NOT_FLAT):
+        raise ValueError("Not a flat map")
+    tokens = inner.split()
+    if len(tokens) % 2:
+        raise ValueError("Odd number of map elements")
+    return {_key(tokens[i]): _value(tokens[i + 1]) for i in range(0, len(tokens), 2)}
+
+
+def decode_with_edn_format(msg):
+    """ General decoding with the edn_format package, for anything the fast path does not handle """
+    import edn_format
+
+    msg_type, _, body = msg.strip().partition(b' ')
+    if not body:
+        return msg_type.decode(), None
+    decoded = edn_format.loads(body.decode())
+
+    # edn_format does not return normal dicts (or string keywords)
+    if isinstance(decoded, edn_format.immutable_dict.ImmutableDict):
+        decoded = {str(key).strip(':'): value for key, value in decoded.dict.items()}
+    return msg_type.decode(), decoded
+
+
+def decode_message(msg):
+    """ Decode one message (bytes, without the trailing newline) to (message type, data) """
+    msg_type, _, body = msg.strip().partition(b' ')
+    try:
+        return msg_type.decode('ascii'), decode_flat_map(body)
+    except ValueError:
+        return decode_with_edn_format(msg)
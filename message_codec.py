@@ -0,0 +1,148 @@
+"""
+Wire format of the control messages, everything but the sample data (see sample_protocol for that).
+
+Every control topic has a declared schema. By default messages go out as a small binary struct:
+a header with a magic byte, the message type, the schema version and the sender id, followed by the
+fields of the schema. JSON is kept as a fallback for debugging: with MQTT_CODEC=json in the environment
+a process sends JSON, e.g. to read the traffic with mosquitto_sub. Receivers understand both, binary
+messages start with MAGIC and JSON ones with b'{', and topics without a schema are always JSON.
+
+Senders are identified by a 32 bit number derived from their name (see sender_id) instead of
+the name itself. Both formats decode to the same dicts with the sender id as a number, JSON from
+older clients that still send names included.
+"""
+import os
+import json
+import zlib
+import struct
+
+MAGIC = 0xA6  # first byte of every binary control message (0xA5 is sample_protocol's)
+HEADER = struct.Struct("<BBBI")  # magic, message type, schema version, sender id
+
+USE_JSON = os.environ.get("MQTT_CODEC", "binary").lower() == "json"
+
+
+def sender_id(name):
+    """ The 32 bit id a component named name sends with """
+    return zlib.crc32(name.encode())
+
+
+def is_binary(payload):
+    return len(payload) >= HEADER.size and payload[0] == MAGIC
+
+
+class Schema:
+    """ Binary layout of the messages on one topic, subclasses define pack and unpack of the body """
+    def __init__(self, type_id, topic, version=1):
+        self.type_id = type_id
+        self.topic = topic
+        self.version = version
+
+    def encode(self, msg, use_json=None):
+        """ Payload for msg, a dict with a numeric 'sender_id' """
+        if USE_JSON if use_json is None else use_json:
+            return json.dumps(msg)
+        return HEADER.pack(MAGIC, self.type_id, self.version, msg['sender_id']) + self.pack(msg)
+
+
+class StructSchema(Schema):
+    """ Messages with a fixed set of numeric fields """
+    def __init__(self, type_id, topic, fmt, fields, version=1):
+        super().__init__(type_id, topic, version)
+        self.body = struct.Struct("<" + fmt)
+        self.fields = fields
+
+    def pack(self, msg):
+        return self.body.pack(*[msg[field] for field in self.fields])
+
+    def unpack(self, body):
+        return dict(zip(self.fields, self.body.unpack(body)))
+
+
+class TransportSchema(StructSchema):
+    """ The TransportWidget's buttons, nested in 'state' as in the JSON messages """
+    def pack(self, msg):
+        return super().pack(msg['state'])
+
+    def unpack(self, body):
+        return {'state': super().unpack(body)}
+
+
+class FaderValuesSchema(Schema):
+    """ Any number of 0..127 fader values, one byte each """
+    def pack(self, msg):
+        return bytes(msg['values'])
+
+    def unpack(self, body):
+        return {'values': list(body)}
+
+
+class PatternStateSchema(Schema):
+    """ Snapshot of a PatternState: the values as one byte per cell, then (version, writer) per cell """
+    grid = struct.Struct("<IHH")  # Lamport clock, ntracks, nsteps
+
+    def pack(self, msg):
+        state = msg['state']
+        ntracks, nsteps = len(state), len(state[0]) if state else 0
+        versions = [number for row in msg['versions'] for version in row for number in version]
+        return b''.join((self.grid.pack(msg['clock'], ntracks, nsteps),
+                         bytes(value for row in state for value in row),
+                         struct.pack(f"<{len(versions)}I", *versions)))
+
+    def unpack(self, body):
+        clock, ntracks, nsteps = self.grid.unpack_from(body)
+        ncells = ntracks * nsteps
+        values = body[self.grid.size:self.grid.size + ncells]
+        numbers = struct.unpack_from(f"<{2 * ncells}I", body, self.grid.size + ncells)
+        versions = [list(version) for version in zip(numbers[::2], numbers[1::2])]
+        return {'state': [list(values[track * nsteps:(track + 1) * nsteps]) for track in range(ntracks)],
+                'versions': [versions[track * nsteps:(track + 1) * nsteps] for track in range(ntracks)],
+                'clock': clock}
+
+
+CLOCK = StructSchema(1, "sequencer/clock", "dddBH", ['beat', 'time', 'bpm', 'steps_per_beat', 'nsteps'])
+EDIT = StructSchema(2, "sequencer/edit", "HHBII", ['track', 'step', 'value', 'version', 'writer'])
+STATE = PatternStateSchema(3, "sequencer/state")
+TRANSPORT = TransportSchema(4, "sampling", "bbb", ['source', 'sync', 'record_pressed'])
+FADER = StructSchema(5, "myChannel", "B", ['val'])
+FADERS = FaderValuesSchema(6, "faders")
+
+SCHEMAS = [CLOCK, EDIT, STATE, TRANSPORT, FADER, FADERS]
+BY_TYPE = {schema.type_id: schema for schema in SCHEMAS}
+BY_TOPIC = {schema.topic: schema for schema in SCHEMAS}
+
+
+def encode(topic, msg, use_json=None):
+    """ Payload for msg on topic, JSON for topics without a schema """
+    schema = BY_TOPIC.get(topic)
+    if schema is None:
+        return json.dumps(msg)
+    return schema.encode(msg, use_json)
+
+
+def decode(payload):
+    """ The message dict of a binary or JSON payload, raises ValueError for unknown types and versions """
+    if not is_binary(payload):
+        return _normalize_json(json.loads(payload))
+    magic, type_id, version, sender = HEADER.unpack_from(payload)
+    schema = BY_TYPE.get(type_id)
+    if schema is None:
+        raise ValueError(f"Unknown message type {type_id}")
+    if version != schema.version:
+        raise ValueError(f"Unsupported version {version} of {schema.topic} messages, expected {schema.version}")
+    msg = schema.unpack(memoryview(payload)[HEADER.size:])
+    msg['sender_id'] = sender
+    return msg
+
+
+def _normalize_json(msg):
+    """ Replace names by sender ids in JSON from older clients """
+    if isinstance(msg.get('sender_id'), str):
+        msg['sender_id'] = sender_id(msg['sender_id'])
+    if isinstance(msg.get('writer'), str):
+        msg['writer'] = sender_id(msg['writer'])
+    for row in msg.get('versions') or []:
+        for version in row:
+            if isinstance(version[1], str):
+                version[1] = sender_id(version[1])
+    return msg
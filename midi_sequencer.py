@@ -3,15 +3,21 @@ Client for running a sequencer on the "sampling computer".
 
 Receives the state from the remote sequencer user interface. 
 Syncs with Live via Ableton Link and triggers the MIDI notes.
+
+Instead of a message per step, the user interfaces get a retained clock anchor on "sequencer/clock"
+(beat at a wall clock time, bpm, steps per beat, pattern length) whenever it changes, and work out
+the current step from it themselves. Wall clock time is the only clock the computers share, so
+they need to be NTP synced for the playhead to line up.
 """
 
-import paho.mqtt.client as mqcl
-import json
+import mqtt_session
+import message_codec
 import pygame.midi
 import time
 import numpy as np
 from collections import namedtuple
 from LinkToPie import LinkInterface
+from pattern_state import PatternState, EDIT_TOPIC, STATE_TOPIC
 from functools import partial
 import threading
 from ui_widgets import LatencyNudgeWidget
@@ -22,99 +28,329 @@ import sys
 # named tuple for midi notes
 MidiNote = namedtuple('MidiNote', ['channel', 'note'])
 
+# note played by each track
+DEFAULT_NOTE_MAP = [MidiNote(channel=10, note=36),
+                    MidiNote(channel=10, note=38),
+                    MidiNote(channel=10, note=42),
+                    MidiNote(channel=10, note=51)]
+
+SPIN_MARGIN = 2e3  # µs, sleep until this close to a deadline and busy-wait for the rest
+MAX_SLEEP = 50e3  # µs, longest sleep before the deadline is recomputed (the tempo may have changed)
+
+SNAPSHOT_DELAY = 1.  # s, edits are compacted into the retained pattern snapshot this long after the first one
+CLOCK_TOLERANCE = 2e3  # µs, republish the clock anchor once extrapolating the last one is off by more
+LOOKAHEAD = 50e3  # µs of steps handed to PortMidi in advance, None to send every step when it is due
+LOOKAHEAD_PERIOD = 20e3  # µs between wake-ups of the lookahead thread
+MIDI_LATENCY = 1  # ms, PortMidi only honours timestamps when the output is opened with a latency > 0
+
+
+def sleep_until(deadline, now, spin_margin=SPIN_MARGIN):
+    """ Wait until deadline (µs on the clock now()), sleeping most of the way and spinning the final stretch """
+    remaining = deadline - now()
+    if remaining > spin_margin:
+        time.sleep((remaining - spin_margin) / 1e6)
+    while now() < deadline:
+        time.sleep(0)  # hands over the GIL, so the MQTT and Link threads are not starved while spinning
+
+
+class LatenessHistogram:
+    """ Counts of how late the steps fired, in bins of bin_width µs (everything beyond max_lateness in the last bin) """
+
+    def __init__(self, bin_width=50., max_lateness=20e3):
+        self.bin_width = bin_width
+        self.counts = np.zeros(int(max_lateness / bin_width) + 1, dtype=np.int64)
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, lateness):
+        lateness = max(lateness, 0.)
+        self.counts[min(int(lateness / self.bin_width), len(self.counts) - 1)] += 1
+        self.total += lateness
+        self.max = max(self.max, lateness)
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    def percentile(self, q):
+        """ Upper edge of the bin holding the q-th percentile """
+        if self.count == 0:
+            return 0.
+        index = np.searchsorted(np.cumsum(self.counts), q / 100 * self.count)
+        return (index + 1) * self.bin_width
+
+    def summary(self):
+        if self.count == 0:
+            return "no steps yet"
+        return (f"{self.count} steps, lateness mean {self.total / self.count:.0f} µs, "
+                f"p50 < {self.percentile(50):.0f} µs, p99 < {self.percentile(99):.0f} µs, max {self.max:.0f} µs")
+
+
+class StepScheduler:
+    """
+    Fires the steps of the Link timeline: the absolute deadline of the next step comes from the
+    local timeline model, the thread sleeps until shortly before it and spins until it is due.
+    `latency` (µs, a callable so it can be nudged while running) fires the steps that much earlier.
+    """
+
+    def __init__(self, link, fire, steps_per_beat=4, latency=lambda: 0., spin_margin=SPIN_MARGIN):
+        self.link = link
+        self.fire = fire  # called with the absolute step number
+        self.steps_per_beat = steps_per_beat
+        self.latency = latency
+        self.spin_margin = spin_margin
+        self.lateness = LatenessHistogram()
+        self.last_step = None
+        self.running = True
+
+    def deadline(self, step):
+        return self.link.timeline.time_at_beat(step / self.steps_per_beat) - self.latency()
+
+    def next_step(self):
+        current = int(np.floor(self.link.timeline.beat_at(self.link.now() + self.latency()) * self.steps_per_beat))
+        if self.last_step is not None:
+            return max(current + 1, self.last_step + 1)
+        return current + 1
+
+    def run(self):
+        while not self.link.timeline.ready:
+            time.sleep(0.01)
+        while self.running:
+            step = self.next_step()
+            deadline = self.deadline(step)
+            # coarse sleeps first, the deadline moves if the tempo or latency changes meanwhile
+            while deadline - self.link.now() > self.spin_margin + MAX_SLEEP:
+                time.sleep(MAX_SLEEP / 1e6)
+                deadline = self.deadline(step)
+            sleep_until(deadline, self.link.now, self.spin_margin)
+
+            self.lateness.add(self.link.now() - deadline)
+            self.last_step = step
+            self.fire(step)
+
+class CompiledPattern:
+    """
+    A step pattern prepared for the step path: the on/off matrix (tracks x steps) as a read-only bool
+    array, and for every step the note on messages of the tracks that are on. Built once per incoming
+    pattern and swapped in as a whole, so each step is a single lookup whatever the size of the grid.
+    """
+
+    def __init__(self, state, note_map, velocity=64):
+        self.matrix = np.array(state, dtype=bool)
+        if self.matrix.ndim != 2:
+            raise ValueError(f"Pattern must be tracks x steps, got shape {self.matrix.shape}")
+        self.ntracks, self.nsteps = self.matrix.shape
+        if self.ntracks > len(note_map):
+            raise ValueError(f"Pattern has {self.ntracks} tracks, but the note map only {len(note_map)} notes")
+        self.matrix.setflags(write=False)
+
+        track_messages = [(0x90 + note.channel, note.note, velocity) for note in note_map]
+        self.step_messages = tuple(tuple(track_messages[track] for track in np.flatnonzero(self.matrix[:, step]))
+                                   for step in range(self.nsteps))
+
+    def messages(self, step):
+        """ Note on messages of an absolute step number """
+        return self.step_messages[step % self.nsteps]
+
+
+class PortMidiClock:
+    """
+    Maps local time (µs on the LinkInterface.now clock) to PortMidi time (ms, pygame.midi.time).
+    The offset is measured at the moment PortMidi's millisecond ticks over, so it is good to a few µs
+    rather than to the 1 ms resolution of pygame.midi.time.
+    """
+
+    def __init__(self, now, midi_time=None):
+        self.now = now
+        self.midi_time = midi_time if midi_time is not None else pygame.midi.time
+        self.offset = 0.
+        self.update()
+
+    def update(self):
+        start = self.midi_time()
+        while True:
+            t = self.now()
+            tick = self.midi_time()
+            if tick != start:
+                break
+        self.offset = tick - t / 1e3
+
+    def to_midi(self, t):
+        return int(round(t / 1e3 + self.offset))
+
+
+class LookaheadScheduler:
+    """
+    Hands the steps of the next `lookahead` µs to schedule(step, due), with due the local time the
+    step has to sound at (latency correction applied), so that the MIDI driver rather than this thread
+    does the precise timing. Wakes every `period` µs, or right away after reschedule() (pattern or tempo
+    changed), and always continues after the last step handed out. PortMidi cannot take back events, so
+    a change reaches the output at most `lookahead` µs later.
+    """
+
+    def __init__(self, link, schedule, steps_per_beat=4, latency=lambda: 0., lookahead=LOOKAHEAD,
+                 period=LOOKAHEAD_PERIOD):
+        self.link = link
+        self.schedule = schedule
+        self.steps_per_beat = steps_per_beat
+        self.latency = latency
+        self.lookahead = lookahead
+        self.period = period
+        self.lateness = LatenessHistogram()  # how late steps were handed out, 0 unless the thread fell behind
+        self.last_step = None
+        self.wake = threading.Event()
+        self.running = True
+
+    def reschedule(self):
+        self.wake.set()
+
+    def due(self, step):
+        return self.link.timeline.time_at_beat(step / self.steps_per_beat) - self.latency()
+
+    def run(self):
+        while not self.link.timeline.ready:
+            time.sleep(0.01)
+        while self.running:
+            self.wake.clear()
+            now = self.link.now()
+            step = int(np.floor(self.link.timeline.beat_at(now + self.latency()) * self.steps_per_beat)) + 1
+            if self.last_step is not None:
+                step = max(step, self.last_step + 1)
+            due = self.due(step)
+            while due <= now + self.lookahead:
+                self.lateness.add(now - due)
+                self.schedule(step, due)
+                self.last_step = step
+                step += 1
+                due = self.due(step)
+            self.wake.wait(self.period / 1e6)
+
+
 class Sequencer:
-    def __init__(self, nsteps=8, ntracks=4):
+    def __init__(self, nsteps=8, ntracks=4, lookahead=LOOKAHEAD, note_map=None, midi_output=None, midi_time=None, link=None):
+        """
+        midi_output (with write() like pygame.midi.Output), midi_time (its clock in ms) and link replace
+        the MIDI device 3 and Carabiner, e.g. with the stand-ins of benchmarks.end_to_end
+        """
         self.nsteps = nsteps
         self.ntracks = ntracks
         self.steps_per_beat = 4
 
-        self.step_state = [[0] * self.nsteps] * 4
-        self.midi_notes = [MidiNote(channel=10, note=36),
-                           MidiNote(channel=10, note=38), 
-                           MidiNote(channel=10, note=42), 
-                           MidiNote(channel=10, note=51)]
+        self.name = "live_sequencer"
+        self.midi_notes = list(note_map) if note_map is not None else DEFAULT_NOTE_MAP
+        self.sender_id = message_codec.sender_id(self.name)
+        self.pattern_state = PatternState(self.ntracks, self.nsteps, writer=self.sender_id)
+        self.step_state = self.pattern_state.values_copy()
+        self.pattern = CompiledPattern(self.step_state, self.midi_notes)
+        self.snapshot_timer = None
+        self.snapshot_lock = threading.Lock()
 
         # midi stuff
         try:
             self.latency_correction = np.loadtxt("latency_config.dat")
         except OSError:  # if load fails
             self.latency_correction = 75e3  # microseconds
-        print(f"Connecting to MIDI out \"{pygame.midi.get_device_info(3)[1].decode()}\"")
-        self.midi_output = pygame.midi.Output(3)
-
-        
+        self.lookahead = lookahead
+        self.midi_time = midi_time if midi_time is not None else pygame.midi.time
+        if midi_output is None:
+            print(f"Connecting to MIDI out \"{pygame.midi.get_device_info(3)[1].decode()}\"")
+            midi_output = pygame.midi.Output(3, latency=MIDI_LATENCY if lookahead else 0)
+        self.midi_output = midi_output
 
         # link stuff
         self.beat = -1
         self.step = -1
-        self.last_state = {'beat': 0., 'time': int(time.time() * 1e6), 'bpm': 120.}
         self.last_when = 0.
 
-        self.link = LinkInterface()  # make sure that carabiner is running before calling this
-        self.link.callbacks['status'] = self.update_link_state_callback
+        self.link = link if link is not None else LinkInterface()  # make sure that carabiner is running before calling this
+        self.midi_clock = PortMidiClock(self.link.now, self.midi_time)
+        self.last_bpm = None
+        self.last_clock = None  # last published clock anchor
+
+        # everything the callbacks use has to exist before the first of them can run
+        if lookahead:
+            self.scheduler = LookaheadScheduler(self.link, self.step_if_its_time, self.steps_per_beat,
+                                                latency=lambda: self.latency_correction, lookahead=lookahead)
+        else:
+            self.scheduler = StepScheduler(self.link, self.step_if_its_time, self.steps_per_beat,
+                                           latency=lambda: self.latency_correction)
+
         self.link.callbacks['phase-at-time'] = self.phase_at_time_callback
-        self.update_thread = threading.Thread(target=self.update_link_state, daemon=True)
-        self.update_thread.start()
+        self.link.callbacks['status'] = self.link_status_callback
 
         # networking stuff
-        self.name = "live_sequencer"
-        mqtt_broker_ip = "localhost"
-        self.mqtt_client = mqcl.Client(client_id=self.name, clean_session=True)
-        self.mqtt_client.on_message = self.on_mqtt_message
-
-        self.mqtt_client.connect(mqtt_broker_ip, 1883, 60)
-        self.mqtt_client.subscribe("sequencer/state", qos=1)
-        self.mqtt_client.loop_start()
+        self.mqtt = mqtt_session.get_session(self.name)
+        self.mqtt.subscribe(STATE_TOPIC, self.on_state_message, qos=1)
+        self.mqtt.subscribe(EDIT_TOPIC, self.on_edit_message, qos=1)
 
-        self.step_thread = threading.Thread(target=self.step_if_its_time, daemon=True)
+        self.update_thread = threading.Thread(target=self.update_link_state, daemon=True)
+        self.update_thread.start()
+        self.step_thread = threading.Thread(target=self.scheduler.run, daemon=True)
         self.step_thread.start()
 
-    def midi_notes_on(self, notes: list):
-        t = pygame.midi.time()
-        midi_messages = [[[0x90 + note.channel, note.note, 64], t] for note in notes]
-        self.midi_output.write(midi_messages)
-
-    def step_if_its_time(self):
-        while True:
-            t_live = int(time.time() * 1e6) + self.latency_correction
-            # if t_live > self.last_state['time']:
-            current_beat = self.last_state['beat'] + (t_live - self.last_state['time']) * self.last_state['bpm'] / 60e6
-            current_step = int(self.steps_per_beat * current_beat)
-
-            if current_step > self.beat:
-                red_step = current_step % len(self.step_state[0])
-                self.beat = current_step
-                self.step = red_step
-                notes_on_list = []
-                for track_id in range(self.ntracks):
-                    if self.step_state[track_id][self.step]:
-                        notes_on_list.append(self.midi_notes[track_id])
-                self.midi_notes_on(notes_on_list)
-
-                self.mqtt_client.publish("sequencer/step", json.dumps({'sender_id': self.name, 'step': self.step}), qos=0, retain=False)
-            time.sleep(0.01)
+    def midi_notes_on(self, notes: list, t=None):
+        """ Note on messages at PortMidi time t (ms), now if None """
+        self.write_midi([(0x90 + note.channel, note.note, 64) for note in notes], t)
+
+    def write_midi(self, messages, t=None):
+        """ Write MIDI messages at PortMidi time t (ms), now if None """
+        if t is None:
+            t = self.midi_time()
+        self.midi_output.write([[message, t] for message in messages])
+
+    def step_if_its_time(self, current_step, due=None):
+        """ Called by the scheduler when the step is due, or ahead of time with the local time it is due at """
+        pattern = self.pattern  # may be swapped by the MQTT thread meanwhile
+        self.beat = current_step
+        self.step = current_step % pattern.nsteps
+        messages = pattern.step_messages[self.step]
+        if messages:
+            # PortMidi sends at timestamp + latency
+            self.write_midi(messages, None if due is None else self.midi_clock.to_midi(due) - MIDI_LATENCY)
 
     def step(self, new_beat):
         print(new_beat)
         self.beat = new_beat
-        notes_on_list = []
-        for track_id in range(self.ntracks):
-            if self.step_state[track_id][self.beat]:
-                notes_on_list.append(self.midi_notes[track_id])
-        self.midi_notes_on(notes_on_list)
-
-        self.mqtt_client.publish("sequencer/step", json.dumps({'sender_id': self.name, 'step': self.beat}), qos=0, retain=False)
+        self.write_midi(self.pattern.messages(self.beat))
 
     def update_link_state(self):
+        """ Keeps the local Link timeline fitted, tempo changes are pushed by Carabiner anyway """
         while True:
             self.link.status()
-            # self.link.phase_at_time(int(time.time() * 1e6 + self.latency_correction), quantum=8.)
-            time.sleep(0.1)
-
-    def update_link_state_callback(self, msg):
-        self.last_state['bpm'] = msg['bpm']
-        self.last_state['beat'] = msg['beat']
-        self.last_state['time'] = int(time.time() * 1e6)
+            time.sleep(1.)
+            self.midi_clock.update()  # in case PortMidi's clock drifts from the monotonic one
+            self.publish_clock()  # catches drift between the Link timeline and the wall clock
+
+    def clock_anchor(self):
+        """ The current beat at the current wall clock time (µs), with what it takes to extrapolate the step """
+        now = self.link.now()
+        wall_time = time.time() * 1e6
+        return {'sender_id': self.sender_id,
+                'beat': self.link.timeline.beat_at(now),
+                'time': wall_time,
+                'bpm': self.link.timeline.bpm,
+                'steps_per_beat': self.steps_per_beat,
+                'nsteps': self.pattern.nsteps}
+
+    def publish_clock(self):
+        """ Publish the retained clock anchor, if it changed or extrapolating the last one is off by too much """
+        if not self.link.timeline.ready:
+            return
+        anchor = self.clock_anchor()
+        last = self.last_clock
+        if last is not None and all(last[key] == anchor[key] for key in ('bpm', 'steps_per_beat', 'nsteps')):
+            extrapolated = last['beat'] + (anchor['time'] - last['time']) * last['bpm'] / 60e6
+            if abs(anchor['beat'] - extrapolated) * 60e6 / anchor['bpm'] < CLOCK_TOLERANCE:
+                return
+        self.last_clock = anchor
+        self.mqtt.send("sequencer/clock", anchor, qos=1, retain=True)
+
+    def link_status_callback(self, msg):
+        if msg['bpm'] != self.last_bpm:
+            self.last_bpm = msg['bpm']
+            if self.lookahead:
+                self.scheduler.reschedule()
+            self.publish_clock()
 
     def phase_at_time_callback(self, msg):
         int_beat = int(msg['phase'])
@@ -123,9 +359,44 @@ class Sequencer:
             self.last_when = msg['when']
 
 
-    def on_mqtt_message(self, client, userdata, msg):
-        msg_dict = json.loads(msg.payload)
-        self.step_state = msg_dict['state']
+    def on_edit_message(self, msg):
+        changed = self.pattern_state.apply_edit(msg.data)
+        self.schedule_snapshot()
+        if changed:
+            self.compile_pattern()
+
+    def on_state_message(self, msg):
+        if self.pattern_state.merge_snapshot(msg.data, msg.data['sender_id']):
+            self.compile_pattern()
+
+    def schedule_snapshot(self):
+        """ Compact the edits into the retained snapshot for late joiners, once per SNAPSHOT_DELAY at most """
+        with self.snapshot_lock:
+            if self.snapshot_timer is None:
+                self.snapshot_timer = threading.Timer(SNAPSHOT_DELAY, self.publish_snapshot)
+                self.snapshot_timer.daemon = True
+                self.snapshot_timer.start()
+
+    def publish_snapshot(self):
+        with self.snapshot_lock:
+            self.snapshot_timer = None
+        snapshot = self.pattern_state.snapshot()
+        snapshot['sender_id'] = self.sender_id
+        self.mqtt.send(STATE_TOPIC, snapshot, qos=1, retain=True)
+
+    def compile_pattern(self):
+        state = self.pattern_state.values_copy()
+        try:
+            pattern = CompiledPattern(state, self.midi_notes)
+        except ValueError as e:
+            print(f"Ignoring pattern: {e}")
+            return
+        self.step_state = state
+        self.ntracks, self.nsteps = pattern.ntracks, pattern.nsteps
+        self.pattern = pattern
+        if self.lookahead:
+            self.scheduler.reschedule()
+        self.publish_clock()  # the pattern length may have changed
 
 def pygame_function(pipe):
     import pygame
@@ -179,6 +450,7 @@ if __name__ == "__main__":
             time.sleep(1000)
     except KeyboardInterrupt:
         pass
+    print(f"Step timing: {sequencer.scheduler.lateness.summary()}")
 
     # sequencer.midi_output.close()
     # np.savetxt("latency_config.dat", np.array([sequencer.latency_correction]))
\ No newline at end of file
@@ -1,16 +1,72 @@
-""" Simple mqtt client """
+""" Simple mqtt client
+
+Faders publish their value only when it changed, at most max_rate times per second, and the last
+value of a drag always goes out (trailing edge). A FaderBank puts many faders on one surface and
+publishes all of their values in a single message per tick.
+
+Usage: python mqtt_client.py <name> [number of faders]
+"""
 
 import paho.mqtt.client as mqcl
+import mqtt_session
 import sys
 import time
-import json
+import threading
+import message_codec
+
+MAX_PUBLISH_RATE = 20.  # messages per second per publisher
+
 
 def on_message(client, userdata, msg):
 	print(msg.payload)
 
+class CoalescingPublisher:
+	"""
+	Publishes to one topic at most max_rate times per second. Payloads in between replace each other,
+	only the latest one is sent when the interval is over, so the final value is never lost.
+	"""
+	def __init__(self, mqtt_client, topic, max_rate=MAX_PUBLISH_RATE, qos=0, retain=True):
+		self.mqtt_client = mqtt_client
+		self.topic = topic
+		self.min_interval = 1. / max_rate
+		self.qos = qos
+		self.retain = retain
+
+		self.last_sent = 0.
+		self.pending = None
+		self.timer = None
+		self.lock = threading.Lock()
+		self.sent_count = 0
+
+	def publish(self, payload):
+		with self.lock:
+			wait = self.last_sent + self.min_interval - time.monotonic()
+			if wait <= 0 and self.timer is None:
+				self._send(payload)
+				return
+			self.pending = payload
+			if self.timer is None:
+				self.timer = threading.Timer(max(wait, 0.), self._flush)
+				self.timer.daemon = True
+				self.timer.start()
+
+	def _flush(self):
+		with self.lock:
+			self.timer = None
+			if self.pending is not None:
+				payload, self.pending = self.pending, None
+				self._send(payload)
+
+	def _send(self, payload):
+		self.last_sent = time.monotonic()
+		self.sent_count += 1
+		self.mqtt_client.publish(self.topic, payload, qos=self.qos, retain=self.retain)
+
 class FaderWidget:
-	def __init__(self, x, y, w, h, mqtt_client=None):
+	def __init__(self, x, y, w, h, mqtt_client=None, name=None, topic="myChannel", max_rate=MAX_PUBLISH_RATE):
 		self.value = 100  # between 0 and 127
+		self.name = name
+		self.sender_id = None if name is None else message_codec.sender_id(name)
 
 		# graphics stuff
 		self.bounding_rect = pygame.Rect(x, y, w, h)
@@ -22,9 +78,12 @@ class FaderWidget:
 		self.drag_start_mouse_y = 0
 		self.drag_start_knob_y = 0
 
-		# networking stuff
+		# networking stuff, without a client the value is published by a FaderBank
 		self.mqtt_client = mqtt_client
-		self.discard_own_messages = True
+		self.publisher = None
+		if not self.mqtt_client is None:
+			self.publisher = CoalescingPublisher(mqtt_client, topic, max_rate)
+		self.published_value = None
 
 	def start_drag_if_clicked(self, mousepos):
 		if self.knob_rect.collidepoint(mousepos):
@@ -44,25 +103,26 @@ class FaderWidget:
 		self.knob_rect.y = new_y
 		self.value = self.y_to_val(new_y)
 
-		if not self.mqtt_client is None:
-			self.mqtt_client.publish("myChannel", json.dumps({'sender_id': my_name, 'val': self.value}), qos=0, retain=True)
-
-	def on_connect(self, client, userdata, flags, rc):
-		self.discard_own_messages = False  # allow to accept one message from myself for getting the retained value
+		if not self.publisher is None and self.value != self.published_value:
+			self.published_value = self.value
+			self.publisher.publish(message_codec.FADER.encode({'sender_id': self.sender_id, 'val': self.value}))
 
 	def update_value_mqtt(self, client, userdata, msg):
-		msg_dict = json.loads(msg.payload)
-		if not ((msg_dict['sender_id'] == my_name) and self.discard_own_messages):
-			if self.discard_own_messages == False:
-				self.discard_own_messages = True
-			new_value = int(msg_dict['val'])
-			if new_value < 0:
-				new_value = 0
-			elif new_value > 127:
-				new_value = 127
-
-			self.value = new_value
-			self.knob_rect.y = self.val_to_y(new_value)
+		self.set_value(message_codec.decode(msg.payload)['val'])
+
+	def set_value(self, new_value):
+		""" Set the value from elsewhere (not while it is being dragged here) """
+		if self.dragging:
+			return
+		new_value = int(new_value)
+		if new_value < 0:
+			new_value = 0
+		elif new_value > 127:
+			new_value = 127
+
+		self.value = new_value
+		self.published_value = new_value
+		self.knob_rect.y = self.val_to_y(new_value)
 
 	def val_to_y(self, val):
 		return int(self.bounding_rect.y + self.bounding_rect.h - self.knob_rect.h - val * (self.bounding_rect.h - self.knob_rect.h) / 127.)
@@ -81,41 +141,103 @@ class FaderWidget:
 		pygame.draw.rect(screen, (255, 255, 255), self.bounding_rect, 1)
 		pygame.draw.rect(screen, (51, 51, 51), self.knob_rect)
 
-my_name = sys.argv[1]
+class FaderBank:
+	"""
+	Many faders side by side on one surface, sharing one topic: the values of all faders go out
+	together in one retained message {'sender_id', 'values': [...]} per tick, if any of them changed.
+	"""
+	def __init__(self, x, y, w, h, nfaders, mqtt_client=None, name=None, topic="faders", max_rate=MAX_PUBLISH_RATE, spacing=0.25):
+		self.name = name
+		self.sender_id = None if name is None else message_codec.sender_id(name)
+		fader_width = w / nfaders
+		self.faders = [FaderWidget(int(x + i * fader_width + spacing * fader_width / 2), y, int((1 - spacing) * fader_width), h)
+					   for i in range(nfaders)]
 
-import pygame
-pygame.init()
+		self.mqtt_client = mqtt_client
+		self.publisher = None
+		if not self.mqtt_client is None:
+			self.publisher = CoalescingPublisher(mqtt_client, topic, max_rate)
+		self.published_values = self.values()
 
-screen = pygame.display.set_mode((400, 600))
-pygame.display.set_caption(my_name)
-screen.fill((0, 0, 0))
+	def values(self):
+		return [fader.value for fader in self.faders]
 
-client = mqcl.Client(client_id=my_name, clean_session=True)
+	def start_drag_if_clicked(self, mousepos):
+		for fader in self.faders:
+			fader.start_drag_if_clicked(mousepos)
+
+	def stop_dragging(self):
+		for fader in self.faders:
+			fader.stop_dragging()
 
-fader = FaderWidget(150, 100, 100, 400, mqtt_client=client)
-fader.draw(screen)
+	@property
+	def dragging(self):
+		return any(fader.dragging for fader in self.faders)
 
-client.on_connect = fader.on_connect
-client.on_message = fader.update_value_mqtt
-client.connect("localhost", 1883, 60)
-client.subscribe("myChannel", qos=0)
-client.loop_start()
+	def drag_update_value(self, mousepos):
+		""" Update the dragged faders and publish all values once if anything changed """
+		for fader in self.faders:
+			if fader.dragging:
+				fader.drag_update_value(mousepos)
+		values = self.values()
+		if not self.publisher is None and values != self.published_values:
+			self.published_values = values
+			self.publisher.publish(message_codec.FADERS.encode({'sender_id': self.sender_id, 'values': values}))
+
+	def update_values_mqtt(self, client, userdata, msg):
+		for fader, value in zip(self.faders, message_codec.decode(msg.payload)['values']):
+			fader.set_value(value)
+		self.published_values = self.values()
 
-running = True
-while running:
-	for event in pygame.event.get():
-		if event.type == pygame.MOUSEBUTTONDOWN:
-			fader.start_drag_if_clicked(pygame.mouse.get_pos())
-		if event.type == pygame.MOUSEBUTTONUP:
-			fader.stop_dragging()
+	def draw(self, screen):
+		for fader in self.faders:
+			fader.draw(screen)
+
+import pygame
+
+if __name__ == "__main__":
+	my_name = sys.argv[1]
+	nfaders = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+
+	pygame.init()
+
+	screen = pygame.display.set_mode((max(400, 40 * nfaders), 600))
+	pygame.display.set_caption(my_name)
+	screen.fill((0, 0, 0))
 
-		if event.type == pygame.QUIT:
-			running = False
+	client = mqcl.Client(client_id=mqtt_session.unique_client_id(my_name), protocol=mqcl.MQTTv5)
 
-	if fader.dragging:
-		fader.drag_update_value(pygame.mouse.get_pos())
+	if nfaders == 1:
+		fader = FaderWidget(150, 100, 100, 400, mqtt_client=client, name=my_name)
+		client.on_message = fader.update_value_mqtt
+		topic = "myChannel"
+	else:
+		fader = FaderBank(20, 100, screen.get_width() - 40, 400, nfaders, mqtt_client=client, name=my_name)
+		client.on_message = fader.update_values_mqtt
+		topic = "faders"
 	fader.draw(screen)
-	pygame.display.flip()
 
-client.disconnect()
-pygame.quit()
+	client.connect("localhost", 1883, 60, clean_start=True)
+	client.subscribe(topic, options=mqtt_session.subscribe_options(qos=0))  # no-local: no echoes of our own values
+	client.loop_start()
+
+	frame_clock = pygame.time.Clock()
+	running = True
+	while running:
+		for event in pygame.event.get():
+			if event.type == pygame.MOUSEBUTTONDOWN:
+				fader.start_drag_if_clicked(pygame.mouse.get_pos())
+			if event.type == pygame.MOUSEBUTTONUP:
+				fader.stop_dragging()
+
+			if event.type == pygame.QUIT:
+				running = False
+
+		if fader.dragging:
+			fader.drag_update_value(pygame.mouse.get_pos())
+		fader.draw(screen)
+		pygame.display.flip()
+		frame_clock.tick(60)
+
+	client.disconnect()
+	pygame.quit()
@@ -0,0 +1,172 @@
+"""
+One MQTT connection per process, shared by all components running in it.
+
+Components subscribe with a handler per topic instead of sharing one on_message callback. Handlers
+are routed to with paho's message_callback_add and get a Message, whose payload is only decoded
+(see message_codec) when a handler asks for it (binary sample chunks never are). The connection is made in the
+background, lost connections are retried with exponential backoff and all subscriptions are
+renewed on every (re)connect.
+
+Clients speak MQTT v5 and subscribe with the no-local option, so the broker never sends a client's
+own messages back to it. Every run connects with a fresh client id: no-local only drops messages of
+the same client id, so retained messages published by the previous run of a component (its last
+state) are still delivered to it on subscribe (retain handling 0, retain flag as published).
+Components that need to see messages of other components in the same process subscribe with
+no_local=False.
+
+The broker is taken from the MQTT_BROKER environment variable ("host" or "host:port"),
+localhost if it is not set, unless the first component asks for another one.
+"""
+import os
+import uuid
+import threading
+import traceback
+import paho.mqtt.client as mqcl
+from paho.mqtt.subscribeoptions import SubscribeOptions
+import message_codec
+
+DEFAULT_PORT = 1883
+MIN_RECONNECT_DELAY = 1  # s, doubled on every failed attempt up to MAX_RECONNECT_DELAY
+MAX_RECONNECT_DELAY = 30
+
+
+def unique_client_id(name):
+    """ Client id for this run of a component """
+    return f"{name}-{uuid.uuid4().hex[:8]}"
+
+
+def subscribe_options(qos=0, no_local=True):
+    """ Options of all our subscriptions, retained messages are sent on every subscribe """
+    return SubscribeOptions(qos=qos, noLocal=no_local, retainAsPublished=True,
+                            retainHandling=SubscribeOptions.RETAIN_SEND_ON_SUBSCRIBE)
+
+
+def broker_address(broker=None):
+    """ (host, port) of the broker, from the argument, MQTT_BROKER or localhost """
+    if broker is None:
+        broker = os.environ.get("MQTT_BROKER", "localhost")
+    host, _, port = broker.partition(":")
+    return host, int(port) if port else DEFAULT_PORT
+
+
+class Message:
+    """ A received message, the control message is decoded from the payload on first access of .data """
+    __slots__ = ('topic', 'payload', 'qos', 'retain', '_data')
+
+    def __init__(self, msg):
+        self.topic = msg.topic
+        self.payload = msg.payload
+        self.qos = msg.qos
+        self.retain = msg.retain
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = message_codec.decode(self.payload)
+        return self._data
+
+
+class MqttSession:
+    def __init__(self, client_id, broker=None, keepalive=60):
+        self.client_id = client_id
+        self.host, self.port = broker_address(broker)
+        self.keepalive = keepalive
+
+        self.handlers = {}  # topic filter -> list of handlers
+        self.subscriptions = {}  # topic filter -> SubscribeOptions it is subscribed with
+        self.connect_callbacks = []
+        self.connected = False
+        self.lock = threading.Lock()
+
+        self.client = mqcl.Client(client_id=unique_client_id(client_id), protocol=mqcl.MQTTv5)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.reconnect_delay_set(MIN_RECONNECT_DELAY, MAX_RECONNECT_DELAY)
+
+    def start(self):
+        """ Connect in the background (retrying until the broker is there) and start the network thread """
+        self.client.connect_async(self.host, self.port, self.keepalive, clean_start=True)
+        self.client.loop_start()
+
+    def stop(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def subscribe(self, topic, handler, qos=0, no_local=True):
+        """
+        Call handler(message) for every message on topic (wildcards allowed), from the network thread.
+        With no_local, messages sent from this process are not delivered.
+        """
+        with self.lock:
+            if topic not in self.handlers:
+                self.handlers[topic] = []
+                self.client.message_callback_add(topic, self._dispatcher(topic))
+            self.handlers[topic].append(handler)
+            current = self.subscriptions.get(topic)
+            if current is not None:  # one subscription for all handlers of the topic
+                qos = max(qos, current.QoS)
+                no_local = no_local and current.noLocal
+            options = subscribe_options(qos, no_local)
+            self.subscriptions[topic] = options
+            if self.connected and (current is None or (current.QoS, current.noLocal) != (qos, no_local)):
+                self.client.subscribe(topic, options=options)
+
+    def on_connect(self, callback):
+        """ Call callback() after every (re)connect, once the subscriptions are renewed """
+        self.connect_callbacks.append(callback)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        return self.client.publish(topic, payload, qos=qos, retain=retain)
+
+    def send(self, topic, msg, qos=0, retain=False):
+        """ Publish a control message dict, encoded with the schema of its topic """
+        return self.publish(topic, message_codec.encode(topic, msg), qos=qos, retain=retain)
+
+    def _dispatcher(self, topic):
+        def dispatch(client, userdata, msg):
+            message = Message(msg)
+            for handler in list(self.handlers[topic]):
+                try:
+                    handler(message)
+                except Exception:
+                    traceback.print_exc()  # one broken handler must not stop the network thread
+        return dispatch
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code != 0:
+            print(f"MQTT connection to {self.host}:{self.port} refused: {reason_code}")
+            return
+        with self.lock:
+            self.connected = True
+            if self.subscriptions:
+                self.client.subscribe(list(self.subscriptions.items()))
+        for callback in self.connect_callbacks:
+            try:
+                callback()
+            except Exception:
+                traceback.print_exc()
+
+    def _on_disconnect(self, client, userdata, reason_code, properties=None):
+        with self.lock:
+            self.connected = False
+        if reason_code != 0:
+            print(f"MQTT connection to {self.host}:{self.port} lost, reconnecting")
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session(client_id, broker=None):
+    """
+    The session of this process, started on first use. Only the first caller's client_id (made unique
+    per run) and broker count, later components share the connection (they identify themselves by
+    sender_id in the payload).
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = MqttSession(client_id, broker)
+            _session.start()
+        return _session
@@ -0,0 +1,91 @@
+"""
+Step pattern shared between the sequencer user interfaces and the midi_sequencer.
+
+Instead of the whole pattern, every pad toggle is sent as a single cell edit on "sequencer/edit",
+stamped with a Lamport clock and the id of its writer (a message_codec.sender_id). A replica takes over an edit only if its
+(version, writer) is greater than that of the cell, so all replicas end up with the same pattern
+whatever order the edits arrive in, and receiving an edit twice changes nothing.
+The midi_sequencer compacts the edits into a retained snapshot on "sequencer/state" for late joiners,
+snapshots are merged cell by cell with the same rule.
+The grid has a fixed size, edits and snapshot cells outside of it are dropped, so that a bad or
+foreign message cannot grow the pattern beyond what the midi_sequencer can play.
+"""
+import threading
+
+EDIT_TOPIC = "sequencer/edit"
+STATE_TOPIC = "sequencer/state"
+
+NO_VERSION = (0, 0)
+
+
+class PatternState:
+    def __init__(self, ntracks, nsteps, writer):
+        self.writer = writer  # has to be unique among the replicas
+        self.clock = 0  # Lamport clock, the highest version seen so far
+        self.values = [[0] * nsteps for _ in range(ntracks)]
+        self.versions = [[NO_VERSION] * nsteps for _ in range(ntracks)]
+        self.lock = threading.Lock()
+
+    @property
+    def ntracks(self):
+        return len(self.values)
+
+    @property
+    def nsteps(self):
+        return len(self.values[0]) if self.values else 0
+
+    def in_range(self, track, step):
+        return 0 <= track < self.ntracks and 0 <= step < self.nsteps
+
+    def _merge_cell(self, track, step, value, version):
+        self.clock = max(self.clock, version[0])
+        if version <= self.versions[track][step]:
+            return False
+        self.versions[track][step] = version
+        changed = self.values[track][step] != value
+        self.values[track][step] = value
+        return changed
+
+    def local_edit(self, track, step, value):
+        """ Change a cell here, return the edit message to send to the other replicas """
+        if not self.in_range(track, step):
+            raise ValueError(f"No cell at track {track}, step {step} in a {self.ntracks}x{self.nsteps} pattern")
+        with self.lock:
+            self.clock += 1
+            self._merge_cell(track, step, value, (self.clock, self.writer))
+        return {'track': track, 'step': step, 'value': value, 'version': self.clock, 'writer': self.writer}
+
+    def apply_edit(self, edit):
+        """ Merge an edit from another replica (or an echo of our own), True if a value changed """
+        if not self.in_range(edit['track'], edit['step']):
+            print(f"Dropping edit of track {edit['track']}, step {edit['step']} outside the {self.ntracks}x{self.nsteps} pattern")
+            return False
+        with self.lock:
+            return self._merge_cell(edit['track'], edit['step'], edit['value'], (edit['version'], edit['writer']))
+
+    def values_copy(self):
+        with self.lock:
+            return [list(row) for row in self.values]
+
+    def snapshot(self):
+        """ The whole state, for the retained "sequencer/state" message """
+        with self.lock:
+            return {'state': [list(row) for row in self.values],
+                    'versions': [[list(version) for version in row] for row in self.versions],
+                    'clock': self.clock}
+
+    def merge_snapshot(self, snapshot, sender_id=0):
+        """
+        Merge a snapshot cell by cell, True if a value changed. Plain full states without versions
+        (from older clients) count as version 0 of the sender. Cells outside of the grid are ignored.
+        """
+        state = snapshot['state']
+        versions = snapshot.get('versions')
+        changed = False
+        with self.lock:
+            for track, row in enumerate(state[:self.ntracks]):
+                for step, value in enumerate(row[:self.nsteps]):
+                    version = tuple(versions[track][step]) if versions is not None else (0, sender_id)
+                    changed |= self._merge_cell(track, step, value, version)
+            self.clock = max(self.clock, snapshot.get('clock', 0))
+        return changed
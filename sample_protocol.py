@@ -0,0 +1,182 @@
+"""
+Framing of recorded samples for the "sampling/data" topic.
+
+Two wire formats are understood:
+- binary (default): a fixed struct header followed by the raw PCM bytes of the chunk
+- json (legacy): base64-encoded slices of the sample wrapped in a JSON document
+
+Binary samples can either be sent in one go once the recording is complete (num_chunks and
+total_length are known from the start) or streamed while recording is still running. Streamed chunks
+carry num_chunks = total_length = 0 and the sample is closed by an "end of sample" message carrying both.
+All chunks of a sample except the last one are chunk_size bytes long, so every chunk can be written
+straight to its offset chunk_index * chunk_size.
+
+Every sample is identified by a random 128 bit id, so that any number of samples can be in flight at once.
+Receivers ask for lost chunks with a resend request on "sampling/resend", listing the missing chunk
+ranges of one sample id.
+
+Both the Sampler (audio computer) and the SampleReceiver (sampling computer) use this module,
+so that the format only has to be defined in one place.
+The PCM data of each binary chunk may be compressed with one of the codecs from sample_codec,
+the codec id in the header says which one.
+"""
+import struct
+import json
+import base64
+import uuid
+import sample_codec
+from collections import namedtuple
+
+MAGIC = 0xA5  # first byte of every binary message, JSON messages always start with b'{'
+PROTOCOL_VERSION = 5
+
+# message kinds
+KIND_DATA = 0
+KIND_END = 1  # end of a streamed sample, chunk_index = num_chunks = total number of chunks
+
+# magic, version, kind, sample_id, chunk_index, num_chunks, chunk_size, total_length, channel, codec
+# chunk_size and total_length count bytes of mono int16 PCM before compression
+HEADER = struct.Struct("<BBB16sIIIQBB")
+
+DEFAULT_CHUNK_KB = 32
+JSON_CHUNK_CHARS = 1024  # chunk size of the legacy format in base64 characters
+JSON_CHUNK_BYTES = JSON_CHUNK_CHARS // 4 * 3
+
+# decoded chunk, identical for both wire formats
+SampleChunk = namedtuple('SampleChunk', ['kind', 'sample_id', 'chunk_index', 'num_chunks', 'chunk_size', 'total_length',
+                                         'channel', 'codec', 'data'])
+
+
+def new_sample_id():
+    return uuid.uuid4().bytes
+
+
+def chunk_size_bytes(chunk_kb):
+    """ Convert a chunk size in kilobytes to bytes, rounded down to whole 16 bit frames """
+    nbytes = int(chunk_kb * 1024) & ~1
+    if nbytes <= 0:
+        raise ValueError(f"Chunk size must be positive, got {chunk_kb} kB")
+    return nbytes
+
+
+def is_binary(payload):
+    return len(payload) >= HEADER.size and payload[0] == MAGIC
+
+
+def encode_chunk(codec, data):
+    """ Compress one chunk, falling back to raw PCM where compression does not pay off """
+    if codec is None or codec.codec_id == sample_codec.CODEC_RAW:
+        return sample_codec.CODEC_RAW, data
+    encoded = codec.encode(data)
+    if len(encoded) >= len(data):
+        return sample_codec.CODEC_RAW, data
+    return codec.codec_id, encoded
+
+
+def binary_chunks(sample, sample_id, channel, chunk_kb=DEFAULT_CHUNK_KB, codec=None):
+    """ Generator yielding the binary messages for the whole sample """
+    chunksize = chunk_size_bytes(chunk_kb)
+    data = memoryview(sample)
+    num_chunks = max(1, -(-len(data) // chunksize))
+    for i in range(num_chunks):
+        codec_id, chunk = encode_chunk(codec, data[i*chunksize:(i+1)*chunksize])
+        header = HEADER.pack(MAGIC, PROTOCOL_VERSION, KIND_DATA, sample_id, i, num_chunks, chunksize, len(data), channel, codec_id)
+        yield b''.join((header, chunk))
+
+
+class SampleStream:
+    """
+    Incremental encoder for a sample that is still being recorded.
+    Audio buffers of any size are fed in, full chunks come out as soon as they are complete.
+    """
+    def __init__(self, sample_id, channel, chunk_kb=DEFAULT_CHUNK_KB, codec=None):
+        self.sample_id = sample_id
+        self.channel = channel
+        self.codec = codec
+        self.chunksize = chunk_size_bytes(chunk_kb)
+
+        self.pending = bytearray()
+        self.chunk_index = 0
+        self.total_length = 0
+        self.finished = False
+
+    def _data_message(self, data):
+        codec_id, chunk = encode_chunk(self.codec, data)
+        header = HEADER.pack(MAGIC, PROTOCOL_VERSION, KIND_DATA, self.sample_id, self.chunk_index, 0, self.chunksize, 0,
+                             self.channel, codec_id)
+        self.chunk_index += 1
+        return b''.join((header, chunk))
+
+    def feed(self, data):
+        """ Append recorded bytes, return the list of messages for all chunks completed by them """
+        if self.finished:  # late audio buffer after the recording was stopped
+            return []
+        self.total_length += len(data)
+        self.pending += data
+        messages = []
+        if len(self.pending) >= self.chunksize:
+            pending = memoryview(self.pending)
+            nfull = len(pending) // self.chunksize
+            for i in range(nfull):
+                messages.append(self._data_message(pending[i*self.chunksize:(i+1)*self.chunksize]))
+            rest = bytes(pending[nfull*self.chunksize:])
+            pending.release()
+            self.pending = bytearray(rest)
+        return messages
+
+    def finish(self):
+        """ Flush the last partial chunk and close the sample with the end marker """
+        self.finished = True
+        messages = []
+        if self.pending or self.chunk_index == 0:
+            messages.append(self._data_message(self.pending))
+            self.pending = bytearray()
+        messages.append(HEADER.pack(MAGIC, PROTOCOL_VERSION, KIND_END, self.sample_id, self.chunk_index, self.chunk_index,
+                                    self.chunksize, self.total_length, self.channel, sample_codec.CODEC_RAW))
+        return messages
+
+
+def decode_binary(payload):
+    """ The data of the returned chunk is decompressed PCM, for raw chunks a memoryview into the payload without copying """
+    magic, version, kind, sample_id, chunk_index, num_chunks, chunk_size, total_length, channel, codec_id = HEADER.unpack_from(payload)
+    if version != PROTOCOL_VERSION:
+        raise ValueError(f"Unsupported sample protocol version {version}")
+    data = sample_codec.decode(codec_id, memoryview(payload)[HEADER.size:])
+    return SampleChunk(kind, sample_id, chunk_index, num_chunks, chunk_size, total_length, channel, codec_id, data)
+
+
+def json_chunks(sample, sample_id, channel, sender_id):
+    """ Generator yielding the messages of the legacy base64-in-JSON format """
+    str_sample = base64.b64encode(sample).decode()
+    chunks = [str_sample[i:i + JSON_CHUNK_CHARS] for i in range(0, len(str_sample), JSON_CHUNK_CHARS)] or ['']
+    num_chunks = len(chunks)
+    for i, chunk in enumerate(chunks):
+        yield json.dumps({'sender_id': sender_id, 'sample_id': sample_id, 'sample': chunk,
+                          'chunk_number': i, 'num_chunks': num_chunks, 'rec_channel': channel})
+
+
+def decode_json(payload):
+    msg_dict = json.loads(payload)
+    return SampleChunk(KIND_DATA, msg_dict['sample_id'], msg_dict['chunk_number'], msg_dict['num_chunks'], JSON_CHUNK_BYTES, 0,
+                       msg_dict['rec_channel'], sample_codec.CODEC_RAW, base64.b64decode(msg_dict['sample']))
+
+
+def decode(payload):
+    """ Decode a message from "sampling/data", whichever wire format it uses """
+    if is_binary(payload):
+        return decode_binary(payload)
+    return decode_json(payload)
+
+
+def resend_request(sender_id, sample_id, ranges, tail=None):
+    """
+    Message asking for the chunks in the half-open ranges [start, stop) of a sample.
+    If tail is given, every chunk from that index on and the end marker are requested as well.
+    """
+    return json.dumps({'sender_id': sender_id, 'sample_id': sample_id.hex(),
+                       'ranges': [list(r) for r in ranges], 'tail': tail})
+
+
+def decode_resend_request(payload):
+    msg_dict = json.loads(payload)
+    return bytes.fromhex(msg_dict['sample_id']), [tuple(r) for r in msg_dict['ranges']], msg_dict['tail']
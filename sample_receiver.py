@@ -1,70 +1,305 @@
-import pyaudio
-import numpy as np
 import time
-import paho.mqtt.client as mqcl
-import json
-import base64
+import mqtt_session
 import wave
 import os
+import threading
+import tempfile
+import mmap
+import json
+import queue
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import sample_protocol
 
-class SampleReceiver:
-    def __init__(self):
-        self.name = "sample_receiver"
-        self.sample_folder = "samples"
-        self.source_labels = ["Baum", "Harfe", "Gedengel", "Mic"]
+class SampleBuffer:
+    """
+    Destination of the chunks of one sample, every chunk is written in place at its offset.
+    Samples of known length up to mmap_threshold bytes get a preallocated bytearray. Longer ones, and streamed
+    ones whose length is only known at the end, are kept in a memory-mapped temporary file instead.
+    """
+    def __init__(self, capacity=None, mmap_threshold=64 * 2**20, initial_file_size=8 * 2**20):
+        self.length = 0  # end of the furthest chunk written so far
+        self.file = None
+        self.buffer = None
+        self.view = None
+
+        if capacity is not None and capacity <= mmap_threshold:
+            self.buffer = bytearray(capacity)
+            self.view = memoryview(self.buffer)
+        else:
+            self.file = tempfile.TemporaryFile()
+            self.map_file(capacity if capacity else initial_file_size)
+
+    def map_file(self, size):
+        if self.view is not None:
+            self.view.release()
+            self.buffer.close()
+        self.file.truncate(size)
+        self.buffer = mmap.mmap(self.file.fileno(), size)
+        self.view = memoryview(self.buffer)
+
+    def write(self, offset, data):
+        end = offset + len(data)
+        if end > len(self.view):
+            if self.file is None:  # more data than announced, move to a file
+                old_view = self.view
+                self.file = tempfile.TemporaryFile()
+                self.view = None
+                self.map_file(max(end, 2 * len(old_view)))
+                self.view[:self.length] = old_view[:self.length]
+                old_view.release()
+            else:
+                self.map_file(max(end, 2 * len(self.view)))
+        self.view[offset:end] = data
+        self.length = max(self.length, end)
+
+    def getbuffer(self):
+        """ The assembled sample, as a memoryview without copying """
+        return self.view[:self.length]
+
+    def close(self):
+        self.view.release()
+        if self.file is not None:
+            self.buffer.close()
+            self.file.close()
+
+
+class SampleAssembly:
+    """ Reassembly state of a single sample in flight """
+    def __init__(self, first_chunk, arrival_time):
+        self.sample_id = first_chunk.sample_id
+        self.channel = first_chunk.channel
+        self.num_chunks = None  # unknown for streamed samples until the end marker arrives
+        self.total_length = None
+
+        self.received = bytearray()  # one flag per chunk index seen so far: 1 if it has arrived
+        self.num_received = 0
+        self.next_chunk = 0  # all chunks before this one have arrived
+
+        # preallocate if the size is known from the header
+        if first_chunk.total_length > 0:
+            self.data = SampleBuffer(first_chunk.total_length)
+        elif first_chunk.num_chunks > 0:
+            self.data = SampleBuffer(first_chunk.num_chunks * first_chunk.chunk_size)
+        else:
+            self.data = SampleBuffer()
+
+        self.last_arrival_time = arrival_time
+        self.last_request_time = 0.
+
+    def add(self, chunk, arrival_time):
+        self.last_arrival_time = arrival_time
+
+        if chunk.num_chunks > 0:
+            self.num_chunks = chunk.num_chunks
+        if chunk.total_length > 0:
+            self.total_length = chunk.total_length
+        if chunk.kind == sample_protocol.KIND_END:
+            return
+
+        i = chunk.chunk_index
+        if i >= len(self.received):
+            self.received.extend(bytes(i + 1 - len(self.received)))
+        if self.received[i]:  # duplicate, e.g. from a resend
+            return
+        self.received[i] = 1
+        self.num_received += 1
+        self.data.write(i * chunk.chunk_size, chunk.data)
+
+        while self.next_chunk < len(self.received) and self.received[self.next_chunk]:
+            self.next_chunk += 1
 
-        self.timeout = 5.
-        self.last_arrival_time = 0.
+    def is_complete(self):
+        return self.num_chunks is not None and self.num_received >= self.num_chunks
 
-        self.chunk_count = 0
-        self.sample_id = None
-        self.sample_chunks = {}
+    def getbuffer(self):
+        if self.total_length is not None:
+            return self.data.getbuffer()[:self.total_length]
+        return self.data.getbuffer()
 
-        self.mqtt_client = mqcl.Client(client_id=self.name, clean_session=True)
-        self.mqtt_client.on_message = self.on_mqtt_message
+    def missing_ranges(self):
+        """ Half-open ranges [start, stop) of chunks that are known to be missing """
+        known = len(self.received) if self.num_chunks is None else self.num_chunks
+        received = self.received + bytes(max(0, known - len(self.received)))
+        ranges = []
+        start = received.find(0, self.next_chunk, known)
+        while start >= 0:
+            stop = received.find(1, start, known)
+            if stop < 0:
+                stop = known
+            ranges.append((start, stop))
+            start = received.find(0, stop, known)
+        return ranges
 
-        self.mqtt_client.connect("localhost", 1883, 60)
-        self.mqtt_client.subscribe("sampling/data", qos=1)
-        self.mqtt_client.loop_start()
+    def missing_tail(self):
+        """ If the end marker has not arrived, everything after the highest chunk seen may be missing """
+        if self.num_chunks is None:
+            return len(self.received)
+        return None
 
 
-    def on_mqtt_message(self, client, userdata, msg):
-        msg_dict = json.loads(msg.payload)
+class SampleWriter:
+    """
+    Writes finished samples to .wav files on a small pool of background threads,
+    so that the MQTT network thread never waits for the disk.
 
-        if not self.sample_id is None and msg_dict['sample_id'] == self.sample_id:
-            if not msg_dict['chunk_number'] in self.sample_chunks:
-                self.sample_chunks[msg_dict['chunk_number']] = base64.b64decode(msg_dict['sample'])
-                self.chunk_count += 1
-                self.last_arrival_time = time.time()
+    submit only queues the sample, it never blocks the network thread. A dispatcher thread hands the
+    queued samples to the pool, with at most max_pending of them being written at a time. At most
+    max_queued more wait in memory, when the disk falls that far behind new samples are dropped.
+    Files are written under a temporary name and renamed once complete, so other programs
+    watching the sample folder never see half-written files.
+    """
+    def __init__(self, sample_folder, on_saved=None, max_workers=2, max_pending=8, max_queued=16):
+        self.sample_folder = sample_folder
+        self.on_saved = on_saved
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sample_writer")
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.queue = queue.Queue(maxsize=max_queued)  # (assembly, file_name) waiting for a slot
+        self.dropped = 0
+        os.makedirs(self.sample_folder, exist_ok=True)
+        threading.Thread(target=self.dispatch, daemon=True).start()
 
-        if self.sample_id is None:
-            self.sample_id = msg_dict['sample_id']
-            self.sample_chunks[msg_dict['chunk_number']] = base64.b64decode(msg_dict['sample'])
-            self.chunk_count = 1
+    def file_name(self, label, sample_id, finish_time):
+        """ Unique file name: time of completion in ms plus the beginning of the sample id """
+        if isinstance(sample_id, bytes):
+            sample_id = sample_id.hex()
+        timestamp = time.strftime("%H%M%S", time.localtime(finish_time)) + f"{int(finish_time * 1000) % 1000:03d}"
+        return f"{label}_{timestamp}_{str(sample_id)[:8]}.wav"
 
-        if msg_dict['sample_id'] == self.sample_id and self.chunk_count == msg_dict['num_chunks']:
-            print("Saving .wav")
-            sample = b''
-            for i in range(self.chunk_count):
-                sample += self.sample_chunks[i]
-            self.sample_chunks = {}
-            self.sample_id = None
-            self.chunk_count = 0
+    def submit(self, assembly, label):
+        """ Queue the sample for writing, returns False if it was dropped because the queue is full """
+        file_name = self.file_name(label, assembly.sample_id, time.time())
+        try:
+            self.queue.put_nowait((assembly, file_name))
+        except queue.Full:
+            self.dropped += 1
+            print(f"Dropping {file_name}, {self.queue.maxsize} samples are already waiting for the disk "
+                  f"({self.dropped} dropped so far)")
+            assembly.data.close()
+            return False
+        return True
 
-            wfile = wave.open(os.path.join(self.sample_folder, self.source_labels[msg_dict['rec_channel']] + "_" + time.strftime("%H%M%S") + ".wav"), 'w')
+    def dispatch(self):
+        """ Waits for free slots, on its own thread so that the backpressure never reaches the network thread """
+        while True:
+            assembly, file_name = self.queue.get()
+            self.slots.acquire()
+            future = self.pool.submit(self.write, assembly, file_name)
+            future.add_done_callback(lambda f: self.slots.release())
+
+    def write(self, assembly, file_name):
+        path = os.path.join(self.sample_folder, file_name)
+        temp_path = path + ".part"
+        sample = assembly.getbuffer()
+        nbytes = len(sample)
+        try:
+            wfile = wave.open(temp_path, 'wb')
             wfile.setnchannels(1)
             wfile.setsampwidth(2)
             wfile.setframerate(44100)
 
             wfile.writeframes(sample)
             wfile.close()
+            os.replace(temp_path, path)
+            print(f"Saved {file_name}")
+        except Exception as e:  # the future is never looked at, anything not caught here would vanish
+            print(f"Saving {file_name} failed: {e!r}")
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return
+        finally:
+            sample.release()
+            assembly.data.close()
+
+        if self.on_saved is not None:
+            try:
+                self.on_saved(assembly, file_name, nbytes)
+            except Exception:
+                traceback.print_exc()
+
+
+class SampleReceiver:
+    def __init__(self, sample_folder="samples"):
+        self.name = "sample_receiver"
+        self.sample_folder = sample_folder
+        self.source_labels = ["Baum", "Harfe", "Gedengel", "Mic"]
+
+        self.timeout = 5.  # give up on a sample after this long without any chunk arriving
+        self.resend_delay = 0.5  # ask for missing chunks after this long without any chunk arriving
+
+        self.assemblies = {}  # sample_id -> SampleAssembly, for all samples in flight
+        self.finished_ids = OrderedDict()  # recently completed or aborted samples, to ignore late duplicates
+        self.max_finished_ids = 256
+        self.lock = threading.Lock()  # assemblies are touched by the network thread and check_for_timeout
+
+        self.writer = SampleWriter(self.sample_folder, on_saved=self.publish_saved)
+
+        self.mqtt = mqtt_session.get_session(self.name)
+        self.mqtt.subscribe("sampling/data", self.on_mqtt_message, qos=1)
+
+    def on_mqtt_message(self, msg):
+        chunk = sample_protocol.decode(msg.payload)
+        arrival_time = time.time()
+
+        with self.lock:
+            if chunk.sample_id in self.finished_ids:
+                return
+            assembly = self.assemblies.get(chunk.sample_id)
+            if assembly is None:
+                assembly = SampleAssembly(chunk, arrival_time)
+                self.assemblies[chunk.sample_id] = assembly
+            assembly.add(chunk, arrival_time)
+
+            complete = assembly.is_complete()
+            if complete:
+                self.finish(assembly)
+            elif chunk.kind == sample_protocol.KIND_END:  # the sender is done, anything missing now is lost
+                self.request_resend(assembly, arrival_time)
+
+        if complete:
+            self.save_sample(assembly)
+
+    def finish(self, assembly):
+        del self.assemblies[assembly.sample_id]
+        self.finished_ids[assembly.sample_id] = True
+        while len(self.finished_ids) > self.max_finished_ids:
+            self.finished_ids.popitem(last=False)
+
+    def request_resend(self, assembly, current_time):
+        if not isinstance(assembly.sample_id, bytes):  # legacy JSON samples cannot be resent
+            return
+        ranges = assembly.missing_ranges()
+        tail = assembly.missing_tail()
+        if ranges or tail is not None:
+            print(f"Requesting resend of chunks {ranges}" + ("" if tail is None else f" and everything from {tail} on"))
+            payload = sample_protocol.resend_request(self.name, assembly.sample_id, ranges, tail)
+            self.mqtt.publish("sampling/resend", payload, qos=1, retain=False)
+        assembly.last_request_time = current_time
+
+    def save_sample(self, assembly):
+        self.writer.submit(assembly, self.source_labels[assembly.channel])
+
+    def publish_saved(self, assembly, file_name, nbytes):
+        """ Let everybody know that a sample is ready to be played """
+        sample_id = assembly.sample_id.hex() if isinstance(assembly.sample_id, bytes) else assembly.sample_id
+        payload = json.dumps({'sender_id': self.name, 'sample_id': sample_id, 'rec_channel': assembly.channel,
+                              'file': file_name, 'num_frames': nbytes // 2})
+        self.mqtt.publish("sampling/saved", payload, qos=1, retain=False)
 
     def check_for_timeout(self, current_time):
-        if (not self.sample_id is None) and current_time - self.last_arrival_time > self.timeout:
-            print("Transmission timed out, aborting")
-            self.sample_id = None
-            self.chunk_count = 0
-            self.sample_chunks = {}
+        """ Abort stalled samples and ask for the missing chunks of samples that went quiet """
+        with self.lock:
+            for assembly in list(self.assemblies.values()):
+                idle_time = current_time - assembly.last_arrival_time
+                if idle_time > self.timeout:
+                    print("Transmission timed out, aborting")
+                    self.finish(assembly)
+                    assembly.data.close()
+                elif idle_time > self.resend_delay and current_time - assembly.last_request_time > self.resend_delay:
+                    self.request_resend(assembly, current_time)
 
 if __name__ == "__main__":
     sample_receiver = SampleReceiver()
@@ -72,4 +307,4 @@ if __name__ == "__main__":
     while True:
         sample_receiver.check_for_timeout(time.time())
         time.sleep(0.1)
-        # keep the thread alive
\ No newline at end of file
+        # keep the thread alive
@@ -4,108 +4,328 @@ and sending it via mqtt to the sampling computer.
 
 This runs on the audio computer.
 """
-import pyaudio
 import numpy as np
 import time
-import paho.mqtt.client as mqcl
-import json
-import base64
+import mqtt_session
+import threading
+import traceback
+from collections import OrderedDict
+import sample_protocol
+import sample_codec
+from LinkToPie import LinkInterface
 
 SAMPLERATE = 44100
+INPUT_DEVICE_INDEX = 4
+INPUT_CHANNELS = 4
+SOURCE_CHANNELS = [0, 1, 2, 3]  # input channel of each source: Baum, Harfe, Gedengel, Mic
+RING_SECONDS = 30.  # length of the always-on input buffer
+PREROLL_SECONDS = 1.  # audio from before the record command that goes into a take
+SYNC_WITH_LINK = True  # needs Carabiner running on the audio computer
+SYNC_QUANTA = [None, 1, 4]  # beats per quantization step of the sync options: None, 1 beat, 1 bar
+PA_CONTINUE = 0  # pyaudio.paContinue
+
+class RingBuffer:
+    """
+    Always-on buffer of the last `capacity` frames of every input channel.
+    The audio callback writes into the preallocated array in place, nothing is allocated per callback.
+    Frames are addressed by their absolute index since the stream was opened.
+    """
+    def __init__(self, nchannels, capacity):
+        self.nchannels = nchannels
+        self.capacity = capacity
+        self.data = np.zeros((nchannels, capacity), dtype='<i2')  # one contiguous row per input channel
+        self.frames_written = 0  # absolute index of the next frame to be written
+
+    def write(self, in_data):
+        frames = np.frombuffer(in_data, dtype='<i2').reshape(-1, self.nchannels).T  # strided view, channel by frame
+        nframes = frames.shape[1]
+        start = self.frames_written % self.capacity
+        first = min(nframes, self.capacity - start)
+        self.data[:, start:start + first] = frames[:, :first]
+        if first < nframes:  # wrap around
+            self.data[:, :nframes - first] = frames[:, first:]
+        self.frames_written += nframes
+
+    def oldest_frame(self):
+        return max(0, self.frames_written - self.capacity)
+
+    def read(self, channel, start, stop):
+        """ Frames [start, stop) of one channel as bytes, they must still be in the buffer """
+        if start < self.oldest_frame() or stop > self.frames_written:
+            raise ValueError(f"Frames {start}-{stop} are not in the buffer")
+        i = start % self.capacity
+        if start // self.capacity == (stop - 1) // self.capacity:
+            return self.data[channel, i:i + stop - start].tobytes()
+        return self.data[channel, i:].tobytes() + self.data[channel, :stop % self.capacity].tobytes()
+
+
+class SampleCache:
+    """
+    Bounded cache of the messages of recently sent samples, used to answer resend requests.
+    The oldest samples are dropped once more than max_bytes are held.
+    """
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.samples = OrderedDict()  # sample_id -> messages in chunk order, end marker last
+        self.lock = threading.Lock()
+
+    def add(self, sample_id, payloads):
+        with self.lock:
+            self.samples.setdefault(sample_id, []).extend(payloads)
+            self.samples.move_to_end(sample_id)
+            self.nbytes += sum(len(payload) for payload in payloads)
+            while self.nbytes > self.max_bytes and len(self.samples) > 1:
+                _, evicted = self.samples.popitem(last=False)
+                self.nbytes -= sum(len(payload) for payload in evicted)
+
+    def get(self, sample_id, ranges, tail=None):
+        """ Messages for the chunk ranges [start, stop), plus everything from index tail on if given """
+        with self.lock:
+            messages = self.samples.get(sample_id)
+            if messages is None:
+                return []
+            requested = [payload for start, stop in ranges for payload in messages[start:stop]]
+            if tail is not None:
+                requested += messages[tail:]
+            return requested
+
+
+class Recording:
+    """ A take of one source, as a range of frames of the ring buffer """
+    def __init__(self, source_id, start_frame, stream=None):
+        self.source_id = source_id
+        self.start_frame = start_frame
+        self.stop_frame = None  # set when the recording is stopped
+        self.next_frame = start_frame  # first frame not yet taken out of the ring buffer
+        self.stream = stream  # SampleStream when uploading while recording
+        self.buffers = []  # otherwise the audio is collected here until the recording stops
+
 
 class Sampler:
-    def __init__(self):
+    def __init__(self, input_channels=INPUT_CHANNELS, source_channels=SOURCE_CHANNELS, ring_seconds=RING_SECONDS,
+                 preroll_seconds=PREROLL_SECONDS, binary_transfer=True, chunk_kb=sample_protocol.DEFAULT_CHUNK_KB,
+                 streaming=True, codec="raw", compression_level=None, link=None):
         self.name = "sampler"
 
-        self.recording_channel = None
-        self.channel_numbers = [1, 2, 3, 4]
+        # audio input: interleaved int16 frames of input_channels channels, each source is one of those channels
+        self.input_channels = input_channels
+        self.source_channels = list(source_channels)
+        if max(self.source_channels) >= self.input_channels:
+            raise ValueError(f"Source channels {self.source_channels} do not fit an input with {self.input_channels} channels")
+
+        # the audio callback only writes to the ring buffer, recordings are cut out of it by the upload thread
+        if preroll_seconds >= ring_seconds:
+            raise ValueError("The pre-roll has to be shorter than the ring buffer")
+        self.ring = RingBuffer(self.input_channels, int(ring_seconds * SAMPLERATE))
+        self.preroll_frames = int(preroll_seconds * SAMPLERATE)
+        self.audio_arrived = threading.Event()
+        self.clock_anchor = (0, 0.)  # (frame index, its capture time on the Link clock in µs), updated by every callback
+
+        # Link timeline, for starting and stopping on beat or bar boundaries
+        self.link = link
+        if self.link is not None:
+            self.link_thread = threading.Thread(target=self.update_link_state, daemon=True)
+            self.link_thread.start()
+
+        # all sources can be recorded at the same time
+        self.recordings = {}  # source_id -> Recording, for the running ones
+        self.stopped_recordings = []  # stopped, but not yet taken out of the ring buffer completely
+        self.recordings_lock = threading.Lock()
+        self.sample_cache = SampleCache()
+
+        # transfer format, see sample_protocol
+        self.binary_transfer = binary_transfer
+        self.chunk_kb = chunk_kb
+        self.codec = sample_codec.make_codec(codec, compression_level)  # only used by the binary format
 
-        self.samples = []
-        self.sample = None
+        # streaming upload: chunks are published while the recording is still running
+        self.streaming = streaming and binary_transfer
+        self.upload_thread = threading.Thread(target=self.upload_recordings, daemon=True)
+        self.upload_thread.start()
 
         # networking stuff
-        self.discard_own_messages = True
-        self.mqtt_client = mqcl.Client(client_id=self.name, clean_session=True)
-        self.mqtt_client.on_message = self.on_mqtt_message
-        self.mqtt_client.on_connect = self.on_mqtt_connect
-
-        mqtt_broker_ip = "localhost"
-        self.mqtt_client.connect(mqtt_broker_ip, 1883, 60)
-        self.mqtt_client.subscribe("timing/beats", qos=0)
-        self.mqtt_client.subscribe("sampling", qos=1)
-        self.mqtt_client.loop_start()
-
-    def on_mqtt_message(self, client, userdata, msg):
-        msg_dict = json.loads(msg.payload)
-        if msg_dict['sender_id'] != self.name:
-            if msg_dict['state']['record_pressed'] and self.recording_channel is None:
-                self.start_recording(msg_dict['state']['source'])
-            elif not (msg_dict['state']['record_pressed']) and not (self.recording_channel is None):
-                self.stop_recording()
-
-    def on_mqtt_connect(self, client, userdata, flags, rc):
-        self.discard_own_messages = False  # enable fetching the last state from the broker
-        # will be turned off when the first message is processed
-
-    def send_sample(self):
+        self.mqtt = mqtt_session.get_session(self.name)
+        self.mqtt.subscribe("sampling", self.on_mqtt_message, qos=1)
+        self.mqtt.subscribe("sampling/resend", self.on_resend_request, qos=1)
+
+    def on_resend_request(self, msg):
+        self.resend_chunks(*sample_protocol.decode_resend_request(msg.payload))
+
+    def on_mqtt_message(self, msg):
+        msg_dict = msg.data
+        source_id = msg_dict['state']['source']
+        sync = msg_dict['state']['sync']
+        if msg_dict['state']['record_pressed'] and not source_id in self.recordings:
+            self.start_recording(source_id, sync)
+        elif not msg_dict['state']['record_pressed']:
+            for source_id in list(self.recordings):
+                self.stop_recording(source_id, sync)
+
+    def send_sample(self, sample, source_id):
         print("Sending sample")
-        str_sample = base64.b64encode(self.sample).decode()
-
-        sample_length = len(str_sample)
-        sample_id = np.random.randint(1000)
-        chunksize = 1024
-        num_full_chunks = sample_length // chunksize
-        remainder = sample_length % chunksize
-        chunks = [str_sample[i*chunksize:(i+1)*chunksize] for i in range(num_full_chunks)]
-        if remainder > 0:
-            chunks.append(str_sample[-remainder:])
-        num_chunks = len(chunks)
-
-        for i, chunk in enumerate(chunks):
-            payload = json.dumps({'sender_id': self.name, 'sample_id': sample_id, 'sample': chunk, 'chunk_number': i, 'num_chunks': num_chunks, 'rec_channel': self.recorded_channel})
-            self.mqtt_client.publish("sampling/data", payload, qos=1, retain=False)
+        sample_id = sample_protocol.new_sample_id()
+        if self.binary_transfer:
+            payloads = list(sample_protocol.binary_chunks(sample, sample_id, source_id, chunk_kb=self.chunk_kb, codec=self.codec))
+            self.sample_cache.add(sample_id, payloads)
+        else:
+            payloads = sample_protocol.json_chunks(sample, sample_id.hex(), source_id, self.name)
+
+        for payload in payloads:
+            self.mqtt.publish("sampling/data", payload, qos=1, retain=False)
         print("Sent sample")
 
-    def start_recording(self, source_id):
-        print("start_recording")
-        self.samples = []
-        self.recording_channel = source_id
+    def upload_recordings(self):
+        """ Take new audio of all recordings out of the ring buffer, runs in its own thread to keep the audio callback short """
+        while True:
+            self.audio_arrived.wait(0.1)
+            self.audio_arrived.clear()
+            with self.recordings_lock:
+                recordings = list(self.recordings.values()) + self.stopped_recordings
+            for recording in recordings:
+                try:
+                    self.drain_recording(recording)
+                except Exception:
+                    # e.g. the audio callback overtook us between the oldest_frame check and the read,
+                    # skip what was lost and keep the thread alive for the other takes
+                    traceback.print_exc()
+                    recording.next_frame = max(recording.next_frame, self.ring.oldest_frame())
+
+    def drain_recording(self, recording):
+        end = self.ring.frames_written
+        if recording.stop_frame is not None:
+            end = min(end, recording.stop_frame)
+        if end > recording.next_frame:
+            if recording.next_frame < self.ring.oldest_frame():
+                print(f"Upload fell behind, dropping {self.ring.oldest_frame() - recording.next_frame} frames")
+                recording.next_frame = self.ring.oldest_frame()
+            data = self.ring.read(self.source_channels[recording.source_id], recording.next_frame, end)
+            recording.next_frame = end
+            if recording.stream is None:
+                recording.buffers.append(data)
+            else:
+                self.publish_chunks(recording.stream, recording.stream.feed(data))
 
-    def stop_recording(self):
-        print("stop_recording")
-        self.recorded_channel = self.recording_channel
-        self.recording_channel = None
-        self.sample = b''.join(self.samples)
-        self.samples = []
-        self.send_sample()
+        if recording.stop_frame is not None and recording.next_frame >= recording.stop_frame:
+            with self.recordings_lock:
+                self.stopped_recordings.remove(recording)
+            if recording.stream is None:
+                self.send_sample(b''.join(recording.buffers), recording.source_id)
+            else:
+                self.publish_chunks(recording.stream, recording.stream.finish())
+                print("Sent sample")
+
+    def publish_chunks(self, stream, payloads):
+        self.sample_cache.add(stream.sample_id, payloads)
+        for payload in payloads:
+            self.mqtt.publish("sampling/data", payload, qos=1, retain=False)
+
+    def resend_chunks(self, sample_id, ranges, tail):
+        """ Answer a resend request, if the sample is one of ours and still cached """
+        payloads = self.sample_cache.get(sample_id, ranges, tail)
+        if payloads:
+            print(f"Resending {len(payloads)} chunks")
+        for payload in payloads:
+            self.mqtt.publish("sampling/data", payload, qos=1, retain=False)
+
+    def update_link_state(self):
+        while True:
+            self.link.status()  # keeps the local Link timeline fitted
+            time.sleep(1.)
+
+    def now(self):
+        """ Current time on the Link clock in µs, see LinkInterface.now """
+        return time.monotonic() * 1e6
+
+    def frame_at_time(self, t):
+        """ Absolute frame index that was or will be captured at Link time t """
+        anchor_frame, anchor_time = self.clock_anchor
+        return anchor_frame + int(round((t - anchor_time) * SAMPLERATE / 1e6))
+
+    def boundary_frame(self, sync):
+        """
+        Frame of the next beat or bar boundary for the sync option (index into SYNC_QUANTA),
+        None if there is nothing to sync to.
+        """
+        quantum = SYNC_QUANTA[sync] if 0 <= sync < len(SYNC_QUANTA) else None
+        if quantum is None or self.link is None or not self.link.timeline.ready:
+            return None
+        beat = self.link.timeline.beat_at(self.now())
+        next_boundary = np.ceil(beat / quantum) * quantum
+        return self.frame_at_time(self.link.timeline.time_at_beat(next_boundary))
+
+    def start_recording(self, source_id, sync=0):
+        """
+        Without sync, the take starts preroll_seconds before now, to make up for the time the command took to get here.
+        With sync, it starts exactly at the next beat or bar boundary.
+        """
+        print(f"start_recording {source_id}")
+        stream = None
+        if self.streaming:
+            stream = sample_protocol.SampleStream(sample_protocol.new_sample_id(), source_id, chunk_kb=self.chunk_kb, codec=self.codec)
+        start_frame = self.boundary_frame(sync)
+        if start_frame is None:
+            start_frame = self.ring.frames_written - self.preroll_frames
+        start_frame = max(start_frame, self.ring.oldest_frame())
+        with self.recordings_lock:
+            self.recordings[source_id] = Recording(source_id, start_frame, stream)
+
+    def stop_recording(self, source_id, sync=0):
+        """ With sync, the take continues up to the next beat or bar boundary """
+        print(f"stop_recording {source_id}")
+        stop_frame = self.boundary_frame(sync)
+        with self.recordings_lock:
+            recording = self.recordings.pop(source_id)
+            if stop_frame is None:
+                stop_frame = self.ring.frames_written
+            recording.stop_frame = max(stop_frame, recording.start_frame)
+            self.stopped_recordings.append(recording)
+        self.audio_arrived.set()  # finish the upload right away
 
     def record_callback(self, in_data, frame_count, time_info, status):
-        # extract the right channel from the data
-        if not self.recording_channel is None:
-            self.samples.append(in_data)
-        return (None, pyaudio.paContinue)
-
-
-pa = pyaudio.PyAudio()
-sampler = Sampler()
-
-# for i in range(pa.get_device_count()):
-#   print(pa.get_device_info_by_index(i))
-# exit()
-
-instream = pa.open(rate=SAMPLERATE,
-                    channels=2,
-                    format=pyaudio.paInt16,
-                    input=True,
-                    input_device_index=4,
-                    stream_callback=sampler.record_callback)
-
-# keep the recording thread alive
-try:
-    while True:
-        time.sleep(0.1)
-except KeyboardInterrupt:
-    instream.stop_stream()
-    instream.close()
-
-    pa.terminate()
+        first_frame = self.ring.frames_written
+        self.ring.write(in_data)
+
+        # capture time of the buffer, from the ADC timestamp on the stream clock where the host API provides it
+        now = time.monotonic()
+        adc_time = time_info.get('input_buffer_adc_time', 0.)
+        if adc_time > 0:
+            buffer_time = now - (time_info['current_time'] - adc_time)
+        else:
+            buffer_time = now - frame_count / SAMPLERATE
+        self.clock_anchor = (first_frame, buffer_time * 1e6)
+
+        self.audio_arrived.set()
+        return (None, PA_CONTINUE)
+
+
+def main():
+    import pyaudio  # only needed for the audio input, Sampler itself works without it
+
+    pa = pyaudio.PyAudio()
+    sampler = Sampler(link=LinkInterface() if SYNC_WITH_LINK else None)
+
+    # for i in range(pa.get_device_count()):
+    #   print(pa.get_device_info_by_index(i))
+    # exit()
+
+    instream = pa.open(rate=SAMPLERATE,
+                        channels=sampler.input_channels,
+                        format=pyaudio.paInt16,
+                        input=True,
+                        input_device_index=INPUT_DEVICE_INDEX,
+                        stream_callback=sampler.record_callback)
+
+    # keep the recording thread alive
+    try:
+        while True:
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        instream.stop_stream()
+        instream.close()
+
+        pa.terminate()
+
+
+if __name__ == "__main__":
+    main()
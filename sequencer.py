@@ -1,14 +1,30 @@
 """
 Simple interface for editing the step-sequencer state remotely.
-Receives the beat info via MQTT from the midi_sequencer on the sampling computer,
+Pad toggles are sent as single versioned cell edits, see pattern_state.
+Receives the clock anchor via MQTT from the midi_sequencer on the sampling computer and moves the
+playhead from it locally (wall clock based, so both computers need to be NTP synced),
 sends state updates via MQTT.
+
+Only pads whose look changed are redrawn and put on the display, and the main loop sleeps until
+the next event, the next playhead move or an idle timeout, at most MAX_FPS frames per second.
+Start with --stats for an FPS/CPU overlay.
 """
-import paho.mqtt.client as mqcl
-import json
+import mqtt_session
+import message_codec
+import math
+import time
+import sys
+import uuid
 
 import pygame
 import pygame.midi
 from functools import partial
+from pattern_state import PatternState, EDIT_TOPIC, STATE_TOPIC
+from ui_widgets import render_cache
+
+MAX_FPS = 60
+IDLE_TIMEOUT = 0.5  # s, longest sleep when no event and no playhead move is due
+REDRAW_EVENT = pygame.USEREVENT + 1  # wakes the main loop when MQTT messages arrive
 
 class SequencerTrack:
     def __init__(self, x, y, w, h, nsteps=8, margin=30, shrink_pad=0.9):
@@ -26,17 +42,39 @@ class SequencerTrack:
         # music stuff
         self.step = -1
         self.state = [0] * self.nsteps
-        
+        self.drawn = None  # (on, playhead) of every pad as it is on the screen, None before the first draw
+
     def draw(self, screen):
-        """ Draw the step pads in their current state on the screen """
-        screen.fill((0, 0, 0), self.bounding_rect)
+        """ Draw the step pads whose look changed since the last draw, return the rects that need updating """
+        if self.drawn is None:
+            screen.fill((0, 0, 0), self.bounding_rect)
+            self.drawn = [None] * self.nsteps
+            dirty = [self.bounding_rect]
+        else:
+            dirty = []
         for i in range(self.nsteps):
-            if self.state[i]:
-                pygame.draw.rect(screen, (0, 255, 0), self.step_rects[i])
-            if i == self.step:
-                pygame.draw.rect(screen, (0, 0, 255), self.step_rects[i])
-                
-            pygame.draw.rect(screen, (255, 255, 255), self.step_rects[i], 1)
+            look = (bool(self.state[i]), i == self.step)
+            if look == self.drawn[i]:
+                continue
+            self.drawn[i] = look
+            screen.blit(self.pad_surface(*look), self.step_rects[i])
+            dirty.append(self.step_rects[i])
+        return dirty
+
+    def pad_surface(self, on, playhead):
+        """ A pad, green when on, blue under the playhead, cached for all tracks """
+        size = self.step_rects[0].size
+
+        def make():
+            surface = pygame.Surface(size)
+            surface.fill((0, 0, 0))
+            if on:
+                surface.fill((0, 255, 0))
+            if playhead:
+                surface.fill((0, 0, 255))
+            pygame.draw.rect(surface, (255, 255, 255), surface.get_rect(), 1)
+            return surface
+        return render_cache.surface(('pad', size, on, playhead), make)
 
     def check_step_click(self, click_pos):
         """ Based on the click_pos coordinates, return which step button was clicked. If none was clicked, return -1. """
@@ -47,96 +85,159 @@ class SequencerTrack:
         return clicked_step
 
 class Sequencer:
-    def __init__(self, x, y, w, h, ntracks=4, nsteps=8, mqtt_broker_ip="192.168.2.107"):
+    def __init__(self, x, y, w, h, ntracks=4, nsteps=8, mqtt_broker_ip=None):
         self.ntracks = ntracks
         self.nsteps = nsteps
-        self.state = [[0] * self.nsteps] * self.ntracks
-
-        # networking stuff
+        self.clock = None  # clock anchor from the midi_sequencer
         self.name = "sequencer_ui"
-        self.discard_own_messages = True
-        self.mqtt_client = mqcl.Client(client_id=self.name, clean_session=True)
-        self.mqtt_client.on_message = self.on_mqtt_message
-        self.mqtt_client.on_connect = self.on_mqtt_connect
-
-        self.mqtt_client.connect(mqtt_broker_ip, 1883, 60)
-        self.mqtt_client.subscribe("sequencer/step", qos=1)
-        self.mqtt_client.subscribe("sequencer/state", qos=1)
-        self.mqtt_client.loop_start()
+        self.sender_id = message_codec.sender_id(self.name)
 
+        # every tablet edits as a writer of its own
+        writer = message_codec.sender_id(f"{self.name}-{uuid.uuid4().hex[:8]}")
+        self.pattern = PatternState(self.ntracks, self.nsteps, writer=writer)
+        self.state = self.pattern.values  # the rows are updated in place and shared with the tracks
         self.tracks = [SequencerTrack(0, i*h//self.ntracks, w, h//self.ntracks, nsteps=self.nsteps) for i in range(self.ntracks)]
+        for track, row in zip(self.tracks, self.state):
+            track.state = row
 
-    def send_state(self):
-        payload = json.dumps({'sender_id': self.name, 
-                                'state': self.state})
-        self.mqtt_client.publish("sequencer/state", payload, qos=1, retain=True)
-
-    def on_mqtt_connect(self, client, userdata, flags, rc):
-        self.discard_own_messages = False
-
-    def on_mqtt_message(self, client, userdata, msg):
-        msg_dict = json.loads(msg.payload)
-        if 'step' in msg_dict:
-            self.update_step(msg_dict['step'])
-        elif 'state' in msg_dict:
-            if not (self.discard_own_messages and msg_dict['sender_id'] == self.name):
-                if msg_dict['sender_id'] == self.name:
-                    self.discard_own_messages = True
-                self.update_state(msg_dict['state'])
+        # networking stuff
+        self.mqtt = mqtt_session.get_session(self.name, mqtt_broker_ip)  # None: MQTT_BROKER or localhost
+        self.mqtt.subscribe("sequencer/clock", self.on_clock_message, qos=1)
+        self.mqtt.subscribe(STATE_TOPIC, self.on_state_message, qos=1)
+        self.mqtt.subscribe(EDIT_TOPIC, self.on_edit_message, qos=1)
+
+    def send_edit(self, edit):
+        self.mqtt.send(EDIT_TOPIC, dict(edit, sender_id=self.sender_id), qos=1, retain=False)
+
+    def on_clock_message(self, msg):
+        self.clock = msg.data
+        self.request_redraw()
+
+    def on_edit_message(self, msg):
+        self.pattern.apply_edit(msg.data)  # echoes of our own edits change nothing
+        self.request_redraw()
+
+    def on_state_message(self, msg):
+        self.pattern.merge_snapshot(msg.data, msg.data['sender_id'])
+        self.request_redraw()
+
+    def request_redraw(self):
+        """ Wake the main loop, called from the network thread """
+        if pygame.display.get_init():
+            pygame.event.post(pygame.event.Event(REDRAW_EVENT))
+
+    def current_step(self):
+        """ Step the midi_sequencer is playing now, extrapolated from its clock anchor, -1 without one """
+        clock = self.clock
+        if clock is None:
+            return -1
+        beat = clock['beat'] + (time.time() * 1e6 - clock['time']) * clock['bpm'] / 60e6
+        return math.floor(beat * clock['steps_per_beat']) % clock['nsteps']
+
+    def time_to_next_step(self):
+        """ Seconds until the playhead moves next, None without a clock anchor """
+        clock = self.clock
+        if clock is None:
+            return None
+        beat = clock['beat'] + (time.time() * 1e6 - clock['time']) * clock['bpm'] / 60e6
+        steps = beat * clock['steps_per_beat']
+        return (math.floor(steps) + 1 - steps) / clock['steps_per_beat'] * 60 / clock['bpm']
 
     def update_step(self, new_step):
         self.step = new_step
         for track in self.tracks:
             track.step = new_step
 
-    def update_state(self, new_state):
-        self.state = new_state
-        for track_id, track in enumerate(self.tracks):
-            track.state = new_state[track_id]
-
     def handle_click(self, click_pos):
         for track_id, track in enumerate(self.tracks):
             clicked_step = track.check_step_click(click_pos)
             if not clicked_step is None:
-                if track.state[clicked_step] == 0:
-                    track.state[clicked_step] = 1
-                else:
-                    track.state[clicked_step] = 0
-                self.state[track_id] = track.state
-                self.send_state()
+                new_value = 0 if track.state[clicked_step] else 1
+                self.send_edit(self.pattern.local_edit(track_id, clicked_step, new_value))
 
     def draw(self, screen):
+        """ Draw what changed, return the rects that need updating on the display """
+        self.update_step(self.current_step())
+        dirty = []
         for track in self.tracks:
-            track.draw(screen)
+            dirty += track.draw(screen)
+        return dirty
 
 
-pygame.init()
-pygame.midi.init()
+class FrameStats:
+    """ Overlay with the frame rate and the CPU use of this process, refreshed once a second """
 
-screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
-width = screen.get_width()
-height = screen.get_height()
+    def __init__(self, x=0, y=0):
+        pygame.font.init()
+        self.font = render_cache.font('Arial', 24)
+        self.pos = (x, y)
+        self.frames = 0
+        self.last_wall = time.monotonic()
+        self.last_cpu = time.process_time()
+        self.rect = None
 
-screen.fill((0, 0, 0))
+    def draw(self, screen):
+        """ Count a frame, return the rects that need updating on the display """
+        self.frames += 1
+        wall = time.monotonic()
+        if wall - self.last_wall < 1.:
+            return []
+        cpu = time.process_time()
+        text = f"{self.frames / (wall - self.last_wall):.1f} fps  {100 * (cpu - self.last_cpu) / (wall - self.last_wall):.0f}% cpu"
+        self.frames, self.last_wall, self.last_cpu = 0, wall, cpu
+
+        surface = self.font.render(text, True, (255, 255, 255), (0, 0, 0))
+        dirty = [surface.get_rect(topleft=self.pos)]
+        if self.rect is not None:
+            screen.fill((0, 0, 0), self.rect)
+            dirty.append(self.rect)
+        screen.blit(surface, self.pos)
+        self.rect = dirty[0]
+        return dirty
+
+
+def main():
+    pygame.init()
+    pygame.midi.init()
+
+    screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
+    width = screen.get_width()
+    height = screen.get_height()
+
+    screen.fill((0, 0, 0))
+
+    sequencer = Sequencer(0, 0, width, height)
+    stats = FrameStats() if "--stats" in sys.argv else None
+    sequencer.draw(screen)
+    pygame.display.flip()
+    frame_clock = pygame.time.Clock()
+
+    ### The main loop
+    running = True
+    while running:
+        # sleep until something happens or the playhead is due to move
+        timeout = sequencer.time_to_next_step()
+        timeout = IDLE_TIMEOUT if timeout is None else min(timeout, IDLE_TIMEOUT)
+        events = [pygame.event.wait(max(1, int(math.ceil(timeout * 1000))))] + pygame.event.get()
+        for event in events:
+            if event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_q:
+                    running = False
+            if event.type == pygame.MOUSEBUTTONDOWN:
+                mousepos = pygame.mouse.get_pos()
+                sequencer.handle_click(mousepos)
+            if event.type == pygame.QUIT:
+                running = False
 
-sequencer = Sequencer(0, 0, width, height)
-sequencer.draw(screen)
+        dirty = sequencer.draw(screen)
+        if stats is not None:
+            dirty += stats.draw(screen)
+        if dirty:
+            pygame.display.update(dirty)
+        frame_clock.tick(MAX_FPS)
 
-### The main loop
-running = True
-while running:
-    for event in pygame.event.get():
-        if event.type == pygame.KEYDOWN:
-            if event.key == pygame.K_q:
-                running = False
-        if event.type == pygame.MOUSEBUTTONDOWN:
-            mousepos = pygame.mouse.get_pos()
-            sequencer.handle_click(mousepos)
-        if event.type == pygame.QUIT:
-            running = False
+    pygame.quit()
 
-    sequencer.draw(screen)
-            
-    pygame.display.flip()
 
-pygame.quit()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import unittest
+
+from LinkToPie import LinkInterface
+from benchmarks.fake_carabiner import FakeCarabiner
+
+
+class ErrorReplyTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeCarabiner()
+        self.link = LinkInterface(tcp_port=self.server.port)
+
+    def tearDown(self):
+        self.link.close()
+        self.server.close()
+
+    def test_bad_args_fails_its_request(self):
+        with self.assertRaises(RuntimeError):
+            self.link.query('beat-at-time', self.link.now(), timeout=1.)  # no quantum
+
+    def test_replies_after_an_error_go_to_their_own_request(self):
+        with self.assertRaises(RuntimeError):
+            self.link.query('beat-at-time', self.link.now(), timeout=1.)
+        reply = self.link.query('beat-at-time', 123, 4, timeout=1.)
+        self.assertEqual(reply['when'], 123)
+
+    def test_status_after_a_bad_bpm_is_not_paired_with_the_failed_request(self):
+        with self.assertRaises(RuntimeError):
+            self.link.query('bpm', 'fast', timeout=1.)
+        for _ in range(3):
+            self.link.query('status', timeout=1.)
+        self.assertEqual(len(self.link._pending['status']), 0)
+
+    def test_unsupported_fails_its_request(self):
+        with self.assertRaises(RuntimeError):
+            self.link.query('enable-start-stop-sync', timeout=1.)
+        self.assertEqual(self.link.query('time-at-beat', 2., 4, timeout=1.)['beat'], 2.)
+
+
+class BrokenSocket:
+    """ The connected socket, but writes fail """
+    def __init__(self, connected):
+        self.connected = connected
+
+    def sendall(self, data):
+        raise BrokenPipeError
+
+    def __getattr__(self, name):
+        return getattr(self.connected, name)
+
+
+class FailedSendTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeCarabiner()
+        self.link = LinkInterface(tcp_port=self.server.port)
+
+    def tearDown(self):
+        self.link.close()
+        self.server.close()
+
+    def test_failed_write_leaves_nothing_pending(self):
+        connected = self.link.s
+        self.link.s = BrokenSocket(connected)
+        future = self.link.request('status')
+        self.link.s = connected
+        with self.assertRaises(OSError):
+            future.result(timeout=1.)
+        self.assertEqual(len(self.link._pending['status']), 0)
+        self.assertIn('bpm', self.link.query('status', timeout=1.))
+
+
+class ListenerTest(unittest.TestCase):
+    def test_socket_stays_blocking_and_close_stops_the_listener(self):
+        server = FakeCarabiner()
+        link = LinkInterface(tcp_port=server.port)
+        self.assertIn('bpm', link.query('status', timeout=1.))
+        self.assertIsNone(link.s.gettimeout())  # no timeout that would also apply to sendall
+        link.close()
+        link._listener_thread.join(2.)
+        self.assertFalse(link._listener_thread.is_alive())
+        server.close()
@@ -0,0 +1,39 @@
+import unittest
+
+from pattern_state import PatternState
+from midi_sequencer import CompiledPattern, DEFAULT_NOTE_MAP
+
+
+class OutOfRangeEditTest(unittest.TestCase):
+    def setUp(self):
+        self.state = PatternState(4, 8, writer=1)
+        self.other = PatternState(4, 8, writer=2)
+
+    def test_out_of_range_edit_is_dropped(self):
+        for track, step in [(5, 0), (0, 8), (-1, 0), (0, -1)]:
+            edit = {'track': track, 'step': step, 'value': 1, 'version': 1, 'writer': 2}
+            self.assertFalse(self.state.apply_edit(edit))
+        self.assertEqual((self.state.ntracks, self.state.nsteps), (4, 8))
+
+    def test_pattern_still_compiles_and_takes_edits_afterwards(self):
+        self.state.apply_edit({'track': 5, 'step': 0, 'value': 1, 'version': 1, 'writer': 2})
+        self.assertTrue(self.state.apply_edit(self.other.local_edit(1, 3, 1)))
+        pattern = CompiledPattern(self.state.values_copy(), DEFAULT_NOTE_MAP)
+        self.assertEqual((pattern.ntracks, pattern.nsteps), (4, 8))
+        self.assertEqual(len(pattern.messages(3)), 1)
+
+    def test_oversized_snapshot_is_cut_to_the_grid(self):
+        big = PatternState(6, 16, writer=2)
+        big.local_edit(1, 2, 1)
+        big.local_edit(5, 12, 1)
+        self.assertTrue(self.state.merge_snapshot(big.snapshot()))
+        self.assertEqual((self.state.ntracks, self.state.nsteps), (4, 8))
+        self.assertEqual(self.state.values[1][2], 1)
+
+    def test_local_edit_out_of_range_raises(self):
+        with self.assertRaises(ValueError):
+            self.state.local_edit(4, 0, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,20 +1,80 @@
 import pygame
 import pygame.gfxdraw
-import paho.mqtt.client as mqcl
-import json
+import mqtt_session
+import message_codec
 import numpy as np
 import base64
 import wave
 import os
 import time
 
+
+class RenderCache:
+    """
+    Fonts, text labels and pre-composed widget surfaces, made once and reused on every frame.
+    Surfaces are keyed by everything that determines their look (state included), so a state
+    change only picks another cached surface.
+    """
+    def __init__(self):
+        self.fonts = {}
+        self.labels = {}
+        self.surfaces = {}
+
+    def font(self, name, size):
+        key = (name, size)
+        if key not in self.fonts:
+            if not pygame.font.get_init():
+                pygame.font.init()
+            self.fonts[key] = pygame.font.SysFont(name, size)
+        return self.fonts[key]
+
+    def label(self, text, size, color=(255, 255, 255, 255), background=None, font='Arial'):
+        key = (text, size, color, background, font)
+        if key not in self.labels:
+            self.labels[key] = self.font(font, size).render(text, True, color, background)
+        return self.labels[key]
+
+    def surface(self, key, make):
+        """ The surface for key, made by calling make() the first time """
+        if key not in self.surfaces:
+            self.surfaces[key] = make()
+        return self.surfaces[key]
+
+    def clear(self):
+        self.fonts.clear()
+        self.labels.clear()
+        self.surfaces.clear()
+
+
+# shared by all widgets
+render_cache = RenderCache()
+
+
+def button_surface(size, fill_color, label=None, font_size=30, border=2):
+    """ A filled button with a white border and an optional centered label, cached """
+    def make():
+        surface = pygame.Surface(size)
+        surface.fill(fill_color)
+        pygame.draw.rect(surface, (255, 255, 255), surface.get_rect(), border)
+        if label is not None:
+            text_surface = render_cache.label(label, font_size, (255, 255, 255, 255), fill_color)
+            surface.blit(text_surface, text_surface.get_rect(center=surface.get_rect().center))
+        return surface
+    return render_cache.surface(('button', tuple(size), fill_color, label, font_size, border), make)
+
+
 class TransportWidget:
     """
     Widget containing the controls for selecting channels
     and starting/stopping the recording.
     """
-    def __init__(self, x, y, w, h, mqtt_broker_ip="192.168.2.107"):
+    def __init__(self, x, y, w, h, mqtt_broker_ip=None, offline=False):
+        """
+        mqtt_broker_ip None uses MQTT_BROKER or localhost (see mqtt_session),
+        offline makes a widget that only draws (e.g. for benchmarks.ui_render)
+        """
         self.name = "sampling_launcher"
+        self.sender_id = message_codec.sender_id(self.name)
         self.sample_folder = "samples"
 
         # graphics stuff
@@ -34,11 +94,9 @@ class TransportWidget:
         self.sync_button_width = int(0.85 * w / 3.)
         self.sync_button_height = 80
         self.sync_button_spacing = w // 3
-        # self.sync_button_rects = [pygame.Rect(x + (self.sync_button_spacing - self.sync_button_width)//2 + i*self.sync_button_spacing, y + self.row_spacing, self.sync_button_width, self.sync_button_height)
-        #                         for i in range(3)]
-        self.sync_button_rects = []
-        # self.sync_labels = ["None", "1 beat", "1 bar"]
-        self.sync_labels = []
+        self.sync_button_rects = [pygame.Rect(x + (self.sync_button_spacing - self.sync_button_width)//2 + i*self.sync_button_spacing, y + self.row_spacing, self.sync_button_width, self.sync_button_height)
+                                for i in range(3)]
+        self.sync_labels = ["None", "1 beat", "1 bar"]  # quantization of record start/stop, see Sampler
 
         # rec/stop button
         self.button_width = 300
@@ -50,75 +108,29 @@ class TransportWidget:
         self.rec_state = 0  # 0: stopped, 1: record pressed
         self.sync_state = 0
         self.source_state = 0
-
-        # networking stuff
-        self.sample_id = None
-        self.sample_chunks = {}
-        self.chunk_count = 0
-
-        self.discard_own_messages = True
-        self.mqtt_client = mqcl.Client(client_id=self.name, clean_session=True)
-        self.mqtt_client.on_message = self.on_mqtt_message
-        self.mqtt_client.on_connect = self.on_mqtt_connect
-
-        self.mqtt_client.connect(mqtt_broker_ip, 1883, 60)
-        self.mqtt_client.subscribe("timing/beats", qos=0)
-        self.mqtt_client.subscribe("sampling", qos=1)
-        self.mqtt_client.subscribe("sampling/data", qos=1)
-        self.mqtt_client.loop_start()
-
-    def on_mqtt_message(self, client, userdata, msg):
-        msg_dict = json.loads(msg.payload)
-
-        if not (self.discard_own_messages and msg_dict['sender_id'] == self.name):
-            if msg_dict['sender_id'] == self.name:
-                self.discard_own_messages = True
-            
-            if 'state' in msg_dict:
-                self.source_state = msg_dict['state']['source']
-                self.sync_state = msg_dict['state']['sync']
-                self.rec_state = msg_dict['state']['record_pressed']
-            # elif 'sample' in msg_dict:
-            #     print(msg_dict)
-            #     if not self.sample_id is None and msg_dict['sample_id'] == self.sample_id:
-            #         if not msg_dict['chunk_number'] in self.sample_chunks:
-            #             self.sample_chunks[msg_dict['chunk_number']] = base64.b64decode(msg_dict['sample'])
-            #             self.chunk_count += 1
-
-            #     if self.sample_id is None:
-            #         self.sample_id = msg_dict['sample_id']
-            #         self.sample_chunks[msg_dict['chunk_number']] = base64.b64decode(msg_dict['sample'])
-            #         self.chunk_count += 1
-
-            #     if msg_dict['sample_id'] == self.sample_id and self.chunk_count == msg_dict['num_chunks']:
-            #         print("Saving .wav")
-            #         sample = b''
-            #         for i in range(self.chunk_count):
-            #             sample += self.sample_chunks[i]
-            #         self.sample_chunks = {}
-            #         self.sample_id = None
-            #         self.chunk_count = 0
-
-            #         wfile = wave.open(os.path.join(self.sample_folder, self.source_labels[msg_dict['rec_channel']] + "_" + time.strftime("%H%M%S") + ".wav"), 'w')
-            #         wfile.setnchannels(1)
-            #         wfile.setsampwidth(2)
-            #         wfile.setframerate(44100)
-
-            #         wfile.writeframes(sample)
-            #         wfile.close()
-
-    def on_mqtt_connect(self, client, userdata, flags, rc):
-        self.discard_own_messages = False  # enable fetching the last state from the broker
-        # will be turned off when the first message is processed
+        self.drawn_state = None  # the state currently on the screen
+
+        # networking stuff, our own messages are not echoed back (no-local), but the state retained
+        # by our previous run is delivered on connect
+        if offline:
+            return
+        self.mqtt = mqtt_session.get_session(self.name, mqtt_broker_ip)
+        self.mqtt.subscribe("sampling", self.on_mqtt_message, qos=1)
+
+    def on_mqtt_message(self, msg):
+        msg_dict = msg.data
+        if 'state' in msg_dict:
+            self.source_state = msg_dict['state']['source']
+            self.sync_state = msg_dict['state']['sync']
+            self.rec_state = msg_dict['state']['record_pressed']
 
     def send_state(self):
-        payload = json.dumps({'sender_id': self.name, 
-                            'state': {
-                                'source': self.source_state,
-                                'sync': self.sync_state,
-                                'record_pressed': self.rec_state
-                            }})
-        self.mqtt_client.publish("sampling", payload, qos=1, retain=True)
+        self.mqtt.send("sampling", {'sender_id': self.sender_id,
+                                    'state': {
+                                        'source': self.source_state,
+                                        'sync': self.sync_state,
+                                        'record_pressed': self.rec_state
+                                    }}, qos=1, retain=True)
 
     def handle_click(self, mousepos):
         if self.rec_stop_rect.collidepoint(mousepos):
@@ -136,64 +148,40 @@ class TransportWidget:
                 self.source_state = i
                 self.send_state()
 
-    def draw_labels(self, screen):
-        """ Draw the labels of the sync switch buttons on the screen """
-        font = pygame.font.SysFont('Arial', self.font_size)
-
-        for i, label in enumerate(self.source_labels):
-            if self.source_state == i:
-                bgcol = (0, 0, 255)
+    def rec_stop_surface(self, rec_state):
+        """ The record button while stopped (red circle) or recording (white square), cached """
+        def make():
+            surface = pygame.Surface(self.rec_stop_rect.size)
+            icon_rect = self.rec_stop_icon_rect.move(-self.rec_stop_rect.x, -self.rec_stop_rect.y)
+            if rec_state == 0:  # "stopped" state
+                surface.fill((0, 0, 0))
+                pygame.draw.rect(surface, (255, 255, 255), surface.get_rect(), 2)
+                pygame.gfxdraw.filled_circle(surface, icon_rect.centerx, icon_rect.centery, self.icon_width//2, (255, 0, 0))
+                pygame.gfxdraw.aacircle(surface, icon_rect.centerx, icon_rect.centery, self.icon_width//2, (255, 0, 0))
             else:
-                bgcol = (0, 0, 0)
-            text_surface = font.render(label, True, (255, 255, 255, 255), bgcol)
-            textrect = text_surface.get_rect()
-            textrect.centerx = self.source_button_rects[i].x + self.source_button_width/2
-            textrect.centery = self.source_button_rects[i].y + self.source_button_height/2
-
-            screen.blit(text_surface, textrect)
-
-        for i, label in enumerate(self.sync_labels):
-            if self.sync_state == i:
-                bgcol = (0, 255, 0)
-            else:
-                bgcol = (0, 0, 0)
-            text_surface = font.render(label, True, (255, 255, 255, 255), bgcol)
-            textrect = text_surface.get_rect()
-            textrect.centerx = self.sync_button_rects[i].x + self.sync_button_width/2
-            textrect.centery = self.sync_button_rects[i].y + self.sync_button_height/2
-
-            screen.blit(text_surface, textrect)
+                surface.fill((255, 0, 0))
+                pygame.draw.rect(surface, (255, 255, 255), surface.get_rect(), 2)
+                pygame.draw.rect(surface, (255, 255, 255), icon_rect)
+            return surface
+        return render_cache.surface(('rec_stop', self.rec_stop_rect.size, self.icon_width, rec_state), make)
+
+    def draw(self, screen, force=False):
+        """ Draw the widget if its state changed since the last draw (or with force), return the rects to update """
+        state = (self.source_state, self.sync_state, self.rec_state)
+        if state == self.drawn_state and not force:
+            return []
+        self.drawn_state = state
+        source_state, sync_state, rec_state = state
 
-    def draw(self, screen):
         screen.fill((0, 0, 0), self.bounding_rect)
-
         for i, button_rect in enumerate(self.source_button_rects):
-            if self.source_state == i:
-                fill_color = (0, 0, 255)
-            else:
-                fill_color = (0, 0, 0)
-            pygame.draw.rect(screen, fill_color, button_rect)
-            pygame.draw.rect(screen, (255, 255, 255), button_rect, 2)
-
+            fill_color = (0, 0, 255) if source_state == i else (0, 0, 0)
+            screen.blit(button_surface(button_rect.size, fill_color, self.source_labels[i], self.font_size), button_rect)
         for i, button_rect in enumerate(self.sync_button_rects):
-            if self.sync_state == i:
-                fill_color = (0, 255, 0)
-            else:
-                fill_color = (0, 0, 0)
-            pygame.draw.rect(screen, fill_color, button_rect)
-            pygame.draw.rect(screen, (255, 255, 255), button_rect, 2)
-
-        self.draw_labels(screen)
-
-        if self.rec_state == 0:  # "stopped" state
-            pygame.draw.rect(screen, (0, 0, 0), self.rec_stop_rect)
-            pygame.draw.rect(screen, (255, 255, 255), self.rec_stop_rect, 2)
-            pygame.gfxdraw.filled_circle(screen, self.rec_stop_icon_rect.centerx, self.rec_stop_icon_rect.centery, self.icon_width//2, (255, 0, 0))
-            pygame.gfxdraw.aacircle(screen, self.rec_stop_icon_rect.centerx, self.rec_stop_icon_rect.centery, self.icon_width//2, (255, 0, 0))
-        else:
-            pygame.draw.rect(screen, (255, 0, 0), self.rec_stop_rect)
-            pygame.draw.rect(screen, (255, 255, 255), self.rec_stop_rect, 2)
-            pygame.draw.rect(screen, (255, 255, 255), self.rec_stop_icon_rect)
+            fill_color = (0, 255, 0) if sync_state == i else (0, 0, 0)
+            screen.blit(button_surface(button_rect.size, fill_color, self.sync_labels[i], self.font_size), button_rect)
+        screen.blit(self.rec_stop_surface(rec_state), self.rec_stop_rect)
+        return [self.bounding_rect.union(self.rec_stop_rect)]
 
 
 class LatencyNudgeWidget:
@@ -211,18 +199,29 @@ class LatencyNudgeWidget:
             clicked_button = 'right'
         return clicked_button
 
-    def draw(self, screen):
-        screen.fill((0, 0, 0), self.bounding_rect)
+    def make_surface(self):
+        surface = pygame.Surface(self.bounding_rect.size)
+        surface.fill((0, 0, 0))
+        left_rect = self.left_rect.move(-self.bounding_rect.x, -self.bounding_rect.y)
+        right_rect = self.right_rect.move(-self.bounding_rect.x, -self.bounding_rect.y)
 
         # blue buttons
-        pygame.draw.rect(screen, (0, 0, 255), self.left_rect)
-        pygame.draw.rect(screen, (0, 0, 255), self.right_rect)
+        pygame.draw.rect(surface, (0, 0, 255), left_rect)
+        pygame.draw.rect(surface, (0, 0, 255), right_rect)
 
         # white triangles
         triangle_half_width = 20
-        pygame.draw.polygon(screen, (255, 255, 255), [(self.left_rect.centerx - triangle_half_width, self.left_rect.centery),
-                                                      (self.left_rect.centerx + triangle_half_width, self.left_rect.centery - triangle_half_width),
-                                                      (self.left_rect.centerx + triangle_half_width, self.left_rect.centery + triangle_half_width)])
-        pygame.draw.polygon(screen, (255, 255, 255), [(self.right_rect.centerx - triangle_half_width, self.right_rect.centery + triangle_half_width),
-                                                      (self.right_rect.centerx - triangle_half_width, self.right_rect.centery - triangle_half_width),
-                                                      (self.right_rect.centerx + triangle_half_width, self.right_rect.centery)])
\ No newline at end of file
+        pygame.draw.polygon(surface, (255, 255, 255), [(left_rect.centerx - triangle_half_width, left_rect.centery),
+                                                       (left_rect.centerx + triangle_half_width, left_rect.centery - triangle_half_width),
+                                                       (left_rect.centerx + triangle_half_width, left_rect.centery + triangle_half_width)])
+        pygame.draw.polygon(surface, (255, 255, 255), [(right_rect.centerx - triangle_half_width, right_rect.centery + triangle_half_width),
+                                                       (right_rect.centerx - triangle_half_width, right_rect.centery - triangle_half_width),
+                                                       (right_rect.centerx + triangle_half_width, right_rect.centery)])
+        return surface
+
+    def draw(self, screen):
+        """ The widget never changes, so it is composed once and blitted from the cache """
+        key = ('latency_nudge', self.bounding_rect.size, tuple(self.left_rect.move(-self.bounding_rect.x, -self.bounding_rect.y)),
+               tuple(self.right_rect.move(-self.bounding_rect.x, -self.bounding_rect.y)))
+        screen.blit(render_cache.surface(key, self.make_surface), self.bounding_rect)
+        return [self.bounding_rect]
\ No newline at end of file